@@ -1,12 +1,36 @@
 import os
+import click
+import cProfile
+import csv
+import io
+import json
+import math
+import pstats
+import tracemalloc
+import queue
+import random
+import re
+import sys
+import time
+import threading
+import zlib
+from collections import Counter, OrderedDict, namedtuple
+from functools import lru_cache
 from dotenv import load_dotenv  # 引入這行 (需要 pip install python-dotenv)
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, abort, g, Response, stream_with_context, send_from_directory
+from flask import before_render_template, template_rendered, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, or_, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import selectinload
 from sqlalchemy.dialects.postgresql import ARRAY
 from flask_wtf import FlaskForm
-from wtforms import StringField, SubmitField, PasswordField, HiddenField, IntegerField, SelectField, TextAreaField
+from flask_wtf.file import FileField, FileRequired, FileAllowed
+from wtforms import StringField, SubmitField, PasswordField, HiddenField, IntegerField, SelectField, TextAreaField, FloatField, BooleanField
 from wtforms.validators import DataRequired, Email, Length, NumberRange
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 from functools import wraps # 用於 login_required
 from datetime import datetime, timedelta
 from wtforms.validators import Optional
@@ -26,8 +50,81 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev_secret_key')
 # 如果本機 .env 有設定，它就會讀到；如果 Render 有設定，它也會讀到。
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
 
+# 設定 DB_DRIVER=psycopg 就改用 psycopg 3 (需要 pip install "psycopg[binary]")：
+# 同一句 SQL 在同一條連線上執行超過 DB_PREPARE_THRESHOLD 次後，會自動變成
+# server-side prepared statement，之後就不用每次重新解析與規劃。
+# 如果前面有 pgbouncer (transaction 模式)，請把 DB_PREPARE_THRESHOLD 設成 none 關掉。
+if app.config['SQLALCHEMY_DATABASE_URI'] and os.environ.get('DB_DRIVER') == 'psycopg':
+    app.config['SQLALCHEMY_DATABASE_URI'] = re.sub(
+        r'^postgres(ql)?(\+\w+)?://', 'postgresql+psycopg://', app.config['SQLALCHEMY_DATABASE_URI'])
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# 連線池設定：gevent 模式下一個 worker 會同時處理很多 request，
+# 連線池要夠大 (DB_POOL_SIZE 建議接近 GUNICORN_WORKER_CONNECTIONS 能承受的並發查詢數)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_pre_ping': True}
+if os.environ.get('DB_POOL_SIZE'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['pool_size'] = int(os.environ['DB_POOL_SIZE'])
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['max_overflow'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['pool_timeout'] = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+if (app.config['SQLALCHEMY_DATABASE_URI'] or '').startswith('postgresql+psycopg://'):
+    threshold = os.environ.get('DB_PREPARE_THRESHOLD', '5')
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {
+        'prepare_threshold': None if threshold.lower() == 'none' else int(threshold)}
+
+# 4. 登入 / 註冊節流設定 (每個 bucket 的容量與每秒回補的 token 數)
+app.config['LOGIN_IP_BURST'] = int(os.environ.get('LOGIN_IP_BURST', 10))
+app.config['LOGIN_IP_PER_MINUTE'] = float(os.environ.get('LOGIN_IP_PER_MINUTE', 10))
+app.config['LOGIN_ACCOUNT_BURST'] = int(os.environ.get('LOGIN_ACCOUNT_BURST', 5))
+app.config['LOGIN_ACCOUNT_PER_MINUTE'] = float(os.environ.get('LOGIN_ACCOUNT_PER_MINUTE', 1))
+app.config['REGISTER_IP_BURST'] = int(os.environ.get('REGISTER_IP_BURST', 5))
+app.config['REGISTER_IP_PER_MINUTE'] = float(os.environ.get('REGISTER_IP_PER_MINUTE', 2))
+# 多個 gunicorn worker 要共用計數時，設定 Redis 位址 (需要 pip install redis)
+app.config['RATELIMIT_STORAGE_URL'] = os.environ.get('RATELIMIT_STORAGE_URL')
+# 密碼雜湊強度：改了之後，使用者下次登入成功時會自動重新雜湊
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+# 超過這個長度的密碼直接拒絕，不送進雜湊函式
+app.config['PASSWORD_MAX_LENGTH'] = 128
+# 讀取 /metrics/auth 需要的 token (沒設定就關閉這個頁面)
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# 前面有幾層可信任的 reverse proxy (Render 是 1 層)。節流要用 X-Forwarded-For 裡真正的
+# 使用者 IP，否則所有人都共用 proxy 的 IP。直接對外、沒有 proxy 時請設成 0，以免被偽造。
+app.config['PROXY_FIX_X_FOR'] = int(os.environ.get('PROXY_FIX_X_FOR', 1))
+if app.config['PROXY_FIX_X_FOR'] > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+
+# 5. 首頁商家列表：依距離搜尋的預設半徑 (公里) 與每頁筆數
+app.config['NEARBY_RADIUS_KM'] = float(os.environ.get('NEARBY_RADIUS_KM', 10))
+app.config['MERCHANTS_PER_PAGE'] = int(os.environ.get('MERCHANTS_PER_PAGE', 12))
+
+# 6. 線上效能剖析：管理員名單 (逗號分隔的 Email)、隨機抽樣比例、檔案存放位置
+app.config['ADMIN_EMAILS'] = {e.strip().lower() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()}
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+app.config['PROFILE_MAX_FILES'] = int(os.environ.get('PROFILE_MAX_FILES', 200))
+app.config['PROFILE_TOKEN_MAX_AGE'] = 3600
+
+# 7. 訂單寫入模式：direct = 每個 request 自己 commit (原本的做法)；
+#    group = 交給背景 writer 每隔幾毫秒把排隊中的訂單合併成一個 transaction 寫入。
+#    group 只在一個 worker 會同時處理多個 request 時才有用 (gevent 或 gthread worker)；
+#    預設的 sync worker 一次只有一個 request，會自動改回 direct (見 place_orders)
+app.config['ORDER_INTAKE_MODE'] = os.environ.get('ORDER_INTAKE_MODE', 'direct')
+app.config['ORDER_GROUP_COMMIT_MS'] = float(os.environ.get('ORDER_GROUP_COMMIT_MS', 5))
+app.config['ORDER_GROUP_MAX_BATCH'] = int(os.environ.get('ORDER_GROUP_MAX_BATCH', 200))
+app.config['ORDER_INTAKE_QUEUE_SIZE'] = int(os.environ.get('ORDER_INTAKE_QUEUE_SIZE', 1000))
+app.config['ORDER_INTAKE_TIMEOUT'] = float(os.environ.get('ORDER_INTAKE_TIMEOUT', 10))
+
+# 8. 訂單事件：讀取時略過最近幾秒內的事件，避免還沒 commit 的較小編號被游標跳過
+#    (限制見 read_order_events 的說明)；商家訂單頁的平均處理時間在每個 worker 裡快取幾秒
+app.config['ORDER_EVENT_SETTLE_SECONDS'] = float(os.environ.get('ORDER_EVENT_SETTLE_SECONDS', 2))
+app.config['ORDER_LATENCY_CACHE_SECONDS'] = float(os.environ.get('ORDER_LATENCY_CACHE_SECONDS', 300))
+
+# 9. 首頁「熱門排行」：計數存放位置 (預設跟登入節流共用 Redis，沒有就放記憶體)、
+#    顯示幾名、排行結果在每個 worker 裡快取幾秒
+app.config['TRENDING_STORAGE_URL'] = os.environ.get('TRENDING_STORAGE_URL', app.config['RATELIMIT_STORAGE_URL'])
+app.config['TRENDING_TOP_N'] = int(os.environ.get('TRENDING_TOP_N', 5))
+app.config['TRENDING_CACHE_SECONDS'] = float(os.environ.get('TRENDING_CACHE_SECONDS', 30))
+
 db = SQLAlchemy(app)
 
 # ==========================================
@@ -44,6 +141,12 @@ class User(db.Model):
     user_contact = db.Column(db.String(50))
     is_vip = db.Column(db.Boolean, default=False)
     vip_expire_time = db.Column(db.DateTime, nullable=True)
+    # 座標 (手動輸入或從地址查表推算)，geohash 用來快速找附近的商家
+    user_lat = db.Column(db.Float, nullable=True)
+    user_lng = db.Column(db.Float, nullable=True)
+    user_geohash = db.Column(db.String(12), index=True, nullable=True)
+    # 商家菜單版本：每次新增 / 修改 / 下架餐點就 +1，快取只要比對這個整數就知道菜單有沒有變
+    menu_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
 class Food(db.Model):
     __tablename__ = 'foods'
@@ -53,17 +156,46 @@ class Food(db.Model):
     food_description = db.Column(db.Text)
     merchant_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
     food_image = db.Column(db.String(500))
+    # 軟刪除：下架的餐點不再出現在菜單上，但保留給歷史訂單顯示
+    food_deleted_at = db.Column(db.DateTime, nullable=True)
+
+    merchant = db.relationship('User', foreign_keys=[merchant_id])
+
+    @classmethod
+    def active(cls):
+        return cls.query.filter(cls.food_deleted_at == None)
 
 class Order(db.Model):
     __tablename__ = 'orders'
     order_id = db.Column(db.Integer, primary_key=True)
     merchant_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
     customer_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
-    order_cart = db.Column(ARRAY(db.Integer, dimensions=2))
+    order_cart = db.Column(ARRAY(db.Integer, dimensions=2).with_variant(db.JSON, 'sqlite'))  # sqlite 只給測試用
     total_price = db.Column(db.Integer, nullable=False)
     order_time = db.Column(db.DateTime, default=datetime.utcnow)
     order_status = db.Column(db.String(50), default='pending')
 
+    merchant = db.relationship('User', foreign_keys=[merchant_id])
+    customer = db.relationship('User', foreign_keys=[customer_id])
+
+# 訂單事件 (只新增、不修改)：每次訂單狀態改變就記一筆，和狀態更新寫在同一個 transaction。
+# 下游 (快取、統計、通知) 用 event_id 當游標往後讀，不用再輪詢整張 orders 表。
+ORDER_EVENT_TYPES = ('created', 'accepted', 'completed', 'rejected', 'cancelled')
+
+class OrderEvent(db.Model):
+    __tablename__ = 'order_events'
+    event_id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.order_id'), nullable=False, index=True)
+    merchant_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
+    event_type = db.Column(db.String(20), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    order = db.relationship('Order', foreign_keys=[order_id])
+
+    # 商家訂單頁依「商家 + 時間區間」統計；只查 merchant_id 時也用得到這個索引 (最左欄)
+    __table_args__ = (db.Index('ix_order_events_merchant_created', 'merchant_id', 'created_at'),)
+
 # ==========================================
 # 2. 表單定義 (Forms) - 參考你的檔案
 # ==========================================
@@ -79,6 +211,8 @@ class RegistrationForm(FlaskForm):
     email = StringField('電子郵件', validators=[DataRequired(), Email()])
     password = PasswordField('密碼', validators=[DataRequired(), Length(min=6)])
     address = StringField('地址', validators=[DataRequired()])
+    latitude = FloatField('緯度 (選填)', validators=[Optional(), NumberRange(min=-90, max=90)])
+    longitude = FloatField('經度 (選填)', validators=[Optional(), NumberRange(min=-180, max=180)])
     contact = StringField('聯絡電話', validators=[DataRequired()])
     identity = SelectField('身分', choices=[('customer', '顧客'), ('merchant', '商家')], validators=[DataRequired()])
     submit = SubmitField('註冊')
@@ -94,6 +228,8 @@ class SettingsForm(FlaskForm):
     # Email 通常不建議隨意修改，或是需要驗證，這裡先設為唯讀顯示即可，不放在可編輯欄位
     contact = StringField('聯絡電話', validators=[DataRequired()])
     address = StringField('地址', validators=[DataRequired()]) # 對應資料庫的 user_position
+    latitude = FloatField('緯度 (選填)', validators=[Optional(), NumberRange(min=-90, max=90)])
+    longitude = FloatField('經度 (選填)', validators=[Optional(), NumberRange(min=-180, max=180)])
     
     # 密碼欄位：如果不填寫代表不修改
     new_password = PasswordField('新密碼 (若不修改請留空)', validators=[Optional(), Length(min=6)])
@@ -114,6 +250,10 @@ class Review(db.Model):
     content = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    order = db.relationship('Order', foreign_keys=[order_id])
+    customer = db.relationship('User', foreign_keys=[customer_id])
+    merchant = db.relationship('User', foreign_keys=[merchant_id])
+
 # ==========================================
 # 3. 定義表單
 # ==========================================
@@ -146,6 +286,1132 @@ class AddFoodForm(FlaskForm):
     food_image = StringField('圖片網址 (請輸入 http 開頭的網址)')
     submit = SubmitField('確認上架')
 
+class ImportMenuForm(FlaskForm):
+    csv_file = FileField('菜單 CSV 檔', validators=[FileRequired(), FileAllowed(['csv'], '只接受 .csv 檔案')])
+    upsert = BooleanField('同名餐點直接更新價格與內容', default=True)
+    submit = SubmitField('開始匯入')
+
+# ==========================================
+# 3.4 批次載入 (Batch Loader)
+# ==========================================
+# 同一個 request 裡，每一種資料表只用一次 IN 查詢把需要的資料撈齊，
+# 已經撈過的就直接從快取拿，避免每個 view 各自手刻 food_map / merchant_map。
+
+class BatchLoader:
+    def __init__(self, model):
+        self.model = model
+        self.pk = model.__mapper__.primary_key[0]
+        self._cache = {}
+
+    def load_many(self, ids):
+        ids = set(ids)
+        missing = [i for i in ids if i not in self._cache]
+        if missing:
+            for obj in self.model.query.filter(self.pk.in_(missing)).all():
+                self._cache[getattr(obj, self.pk.key)] = obj
+            for i in missing:
+                self._cache.setdefault(i, None)
+        return {i: self._cache[i] for i in ids if self._cache[i] is not None}
+
+    def load(self, id):
+        return self.load_many([id]).get(id)
+
+
+def get_loader(model):
+    loaders = g.setdefault('batch_loaders', {})
+    if model not in loaders:
+        loaders[model] = BatchLoader(model)
+    return loaders[model]
+
+
+def refresh_all(objs):
+    """commit 之後物件都會過期，用每種資料表一次 IN 查詢把它們重新載入。"""
+    by_model = {}
+    for obj in objs:
+        by_model.setdefault(type(obj), []).append(db.inspect(obj).identity[0])
+    for model, ids in by_model.items():
+        pk = model.__mapper__.primary_key[0]
+        model.query.filter(pk.in_(ids)).all()
+
+
+def bump_menu_version(merchant_id):
+    """在目前的 transaction 裡把商家的菜單版本 +1 (用 UPDATE 直接加，多個 request 同時改也不會漏算)。"""
+    db.session.execute(db.update(User).where(User.user_id == merchant_id)
+                       .values(menu_version=User.menu_version + 1))
+
+
+def cart_food_ids(orders):
+    ids = set()
+    for o in orders:
+        if o.order_cart:
+            for item in o.order_cart:
+                ids.add(item[0])
+    return ids
+
+# ==========================================
+# 3.45 唯讀列表查詢 (Projections)
+# ==========================================
+# 列表頁只讀、而且只用到幾個欄位，不需要完整的 ORM 物件。這裡直接 SELECT
+# 需要的欄位，拿回來的是 SQLAlchemy 的 Row (類似 namedtuple、用 __slots__)，
+# 不會進 session 的 identity map，也不會把用不到的 TEXT 欄位撈回來。
+MERCHANT_CARD_COLUMNS = (User.user_id, User.user_name, User.user_position, User.user_lat, User.user_lng)
+
+
+def merchant_cards_stmt(*criteria, order_by=None, offset=None, limit=None):
+    stmt = db.select(*MERCHANT_CARD_COLUMNS).where(User.user_identity == 'merchant', *criteria)
+    if order_by is not None:
+        stmt = stmt.order_by(order_by)
+    if offset:
+        stmt = stmt.offset(offset)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return stmt
+
+
+def merchant_cards(*criteria, order_by=None, offset=None, limit=None):
+    return db.session.execute(merchant_cards_stmt(*criteria, order_by=order_by, offset=offset, limit=limit)).all()
+
+
+def menu_cards_stmt(merchant_id, description_chars=None):
+    description = Food.food_description
+    if description_chars is not None:
+        description = func.substr(Food.food_description, 1, description_chars + 1).label('food_description')
+    return (db.select(Food.food_id, Food.food_name, Food.food_price, Food.food_image, description)
+            .where(Food.merchant_id == merchant_id, Food.food_deleted_at == None)
+            .order_by(Food.food_id))
+
+
+def menu_cards(merchant_id, description_chars=None):
+    """商家目前上架中的餐點。description_chars 有設定時只取描述的前幾個字 (多取一個字讓模板判斷要不要加 ...)。"""
+    return db.session.execute(menu_cards_stmt(merchant_id, description_chars)).all()
+
+
+def shop_merchant_stmt(merchant_id):
+    return (db.select(User.user_id, User.user_name, User.user_position, User.menu_version)
+            .where(User.user_id == merchant_id))
+
+
+def review_rows_stmt(merchant_id):
+    return (db.select(Review.review_id, Review.rating, Review.content, Review.created_at,
+                      User.user_name.label('customer_name'))
+            .outerjoin(User, User.user_id == Review.customer_id)
+            .where(Review.merchant_id == merchant_id)
+            .order_by(Review.created_at.desc()))
+
+
+# pipeline 直接用 psycopg 的 cursor 送 SQL，不經過 SQLAlchemy 的編譯快取，
+# 所以自己依 statement 的 cache key 存一份編譯好的 SQL，同樣形狀的查詢只編譯一次。
+# 這裡用到 SQLAlchemy 的內部 API (_generate_cache_key、_bind_processors、
+# construct_params(extracted_parameters=))，所以 requirements.txt 鎖了版本範圍；
+# 升級 SQLAlchemy 前先用 Postgres 跑 tests/test_pipelined.py。
+PIPELINE_SQL_CACHE_SIZE = 200
+_pipeline_sql_cache = OrderedDict()
+_pipeline_sql_lock = threading.Lock()
+pipeline_sql_stats = Counter()  # hit / miss，給 bench-hot-queries 看
+
+
+def _pipeline_sql(stmt, dialect):
+    """回傳 (SQL 字串, 參數 dict)。"""
+    cache_key = stmt._generate_cache_key()
+    if cache_key is None:  # 無法產生 cache key 的 statement 每次都重新編譯
+        compiled = stmt.compile(dialect=dialect, compile_kwargs={'render_postcompile': True})
+        return compiled.string, compiled.params
+    key = (dialect.name, cache_key.key)
+    with _pipeline_sql_lock:
+        compiled = _pipeline_sql_cache.get(key)
+        if compiled is not None:
+            _pipeline_sql_cache.move_to_end(key)
+        pipeline_sql_stats['hit' if compiled is not None else 'miss'] += 1
+    if compiled is None:
+        compiled = stmt.compile(dialect=dialect, cache_key=cache_key)
+        if compiled.post_compile_params:
+            # IN (...) 這類參數要依個數展開，SQL 每次都不一樣，不能快取
+            compiled = stmt.compile(dialect=dialect, compile_kwargs={'render_postcompile': True})
+            return compiled.string, compiled.params
+        with _pipeline_sql_lock:
+            _pipeline_sql_cache[key] = compiled
+            while len(_pipeline_sql_cache) > PIPELINE_SQL_CACHE_SIZE:
+                _pipeline_sql_cache.popitem(last=False)
+    # 這次 statement 帶的參數值，套進快取裡編譯好的 SQL
+    params = compiled.construct_params(extracted_parameters=cache_key.bindparams)
+    processors = compiled._bind_processors
+    return compiled.string, {k: processors[k](v) if k in processors else v for k, v in params.items()}
+
+
+@lru_cache(maxsize=PIPELINE_SQL_CACHE_SIZE)
+def _row_type(keys):
+    return namedtuple('Row', keys)
+
+
+def execute_pipelined(*stmts):
+    """多個互不相依的 SELECT 一起送出，只等一次網路來回 (psycopg 3 的 pipeline 模式)。
+
+    其他驅動 (psycopg2、SQLite) 就依序執行。回傳每個查詢的結果列表，每列是 namedtuple。
+    pipeline 模式也會觸發 before/after_cursor_execute 事件 (context 為 None)，
+    效能剖析一樣算得到這幾句 SQL。欄位值直接用 psycopg 轉好的型別，不經過 SQLAlchemy 的 result processor。
+    """
+    conn = db.session.connection()
+    raw = conn.connection.driver_connection
+    if not hasattr(raw, 'pipeline'):
+        return [db.session.execute(stmt).all() for stmt in stmts]
+    queries = [_pipeline_sql(stmt, conn.dialect) for stmt in stmts]
+    cursors = []
+    with raw.pipeline():
+        for sql, params in queries:
+            cur = raw.cursor()
+            conn.dispatch.before_cursor_execute(conn, cur, sql, params, None, False)
+            cur.execute(sql, params)
+            cursors.append(cur)
+    results = []
+    for stmt, cur, (sql, params) in zip(stmts, cursors, queries):
+        row_type = _row_type(tuple(stmt.selected_columns.keys()))
+        results.append([row_type(*r) for r in cur.fetchall()])
+        conn.dispatch.after_cursor_execute(conn, cur, sql, params, None, False)
+        cur.close()
+    return results
+
+
+def food_cards(food_ids):
+    """訂單明細要顯示的餐點 (包含已下架的)，回傳 {food_id: Row}。"""
+    if not food_ids:
+        return {}
+    return {row.food_id: row for row in db.session.execute(food_cards_stmt(food_ids))}
+
+
+def food_cards_stmt(food_ids):
+    return (db.select(Food.food_id, Food.food_name, Food.food_price, Food.food_image)
+            .where(Food.food_id.in_(food_ids)))
+
+
+def customer_order_rows(customer_id):
+    """顧客的歷史訂單，連商家名稱一起用一次 JOIN 撈回來。"""
+    return db.session.execute(customer_order_rows_stmt(customer_id)).all()
+
+
+def customer_order_rows_stmt(customer_id):
+    return (db.select(Order.order_id, Order.merchant_id, Order.order_cart, Order.total_price,
+                      Order.order_time, Order.order_status, User.user_name.label('merchant_name'))
+            .outerjoin(User, User.user_id == Order.merchant_id)
+            .where(Order.customer_id == customer_id)
+            .order_by(Order.order_time.desc()))
+
+# ==========================================
+# 3.5 登入防護 (Rate Limiting)
+# ==========================================
+# 密碼雜湊 (scrypt / PBKDF2) 很吃 CPU，在雜湊之前先用 token bucket 擋掉大量嘗試。
+# 預設存在記憶體 (每個 worker 各自計算)；有設定 RATELIMIT_STORAGE_URL 時改用 Redis 共用。
+
+class MemoryBucketStorage:
+    MAX_KEYS = 50000
+    PRUNE_INTERVAL = 60
+
+    def __init__(self):
+        self._buckets = OrderedDict()  # key -> (tokens, ts, capacity, rate)，依最近使用排序
+        self._lock = threading.Lock()
+        self._last_prune = 0
+
+    def take(self, key, capacity, rate, now):
+        with self._lock:
+            tokens, ts = self._buckets.pop(key, (capacity, now))[:2]
+            tokens = min(capacity, tokens + (now - ts) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, capacity, rate)
+            if now - self._last_prune >= self.PRUNE_INTERVAL:
+                self._prune(now)
+            # 還是太多就丟掉最久沒用到的 (LRU)，每次只丟一個
+            while len(self._buckets) > self.MAX_KEYS:
+                self._buckets.popitem(last=False)
+            return allowed
+
+    def _prune(self, now):
+        # 已經補滿的 bucket 跟不存在是一樣的，可以直接丟掉 (各自用自己的容量與回補速度判斷)
+        self._last_prune = now
+        full = [k for k, (t, ts, capacity, rate) in self._buckets.items() if t + (now - ts) * rate >= capacity]
+        for k in full:
+            del self._buckets[k]
+
+
+class RedisBucketStorage:
+    SCRIPT = """
+    local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local tokens = tonumber(data[1]) or capacity
+    local ts = tonumber(data[2]) or now
+    tokens = math.min(capacity, tokens + (now - ts) * rate)
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return allowed
+    """
+
+    def __init__(self, url):
+        import redis
+        self._client = redis.Redis.from_url(url, socket_connect_timeout=1, socket_timeout=1)
+        self._script = self._client.register_script(self.SCRIPT)
+        self._errors = redis.RedisError
+        # Redis 掛掉或逾時的時候不能讓登入/註冊跟著 500，先退回這個 worker 自己的記憶體計數
+        self._fallback = MemoryBucketStorage()
+        self._degraded = False
+
+    def take(self, key, capacity, rate, now):
+        try:
+            allowed = bool(self._script(keys=['foodsheep:rl:' + key], args=[capacity, rate, now]))
+        except self._errors as e:
+            record_auth_metric('ratelimit_storage_error')
+            if not self._degraded:  # 只在剛斷線時記一次，不要每個請求都洗版
+                self._degraded = True
+                app.logger.warning('節流用的 Redis 無法使用 (%s)，暫時改用記憶體計數', e)
+            return self._fallback.take(key, capacity, rate, now)
+        if self._degraded:
+            self._degraded = False
+            app.logger.info('節流用的 Redis 恢復連線')
+        return allowed
+
+
+class TokenBucket:
+    def __init__(self, name, capacity, per_minute, storage):
+        self.name = name
+        self.capacity = capacity
+        self.rate = per_minute / 60.0
+        self.storage = storage
+
+    def allow(self, key):
+        return self.storage.take(f'{self.name}:{key}', self.capacity, self.rate, time.time())
+
+
+def _make_bucket_storage():
+    url = app.config['RATELIMIT_STORAGE_URL']
+    if url:
+        try:
+            return RedisBucketStorage(url)
+        except ImportError:
+            app.logger.warning('RATELIMIT_STORAGE_URL 已設定但沒有安裝 redis，改用記憶體計數')
+    return MemoryBucketStorage()
+
+
+_bucket_storage = _make_bucket_storage()
+login_ip_bucket = TokenBucket('login-ip', app.config['LOGIN_IP_BURST'],
+                              app.config['LOGIN_IP_PER_MINUTE'], _bucket_storage)
+login_account_bucket = TokenBucket('login-account', app.config['LOGIN_ACCOUNT_BURST'],
+                                   app.config['LOGIN_ACCOUNT_PER_MINUTE'], _bucket_storage)
+register_ip_bucket = TokenBucket('register-ip', app.config['REGISTER_IP_BURST'],
+                                 app.config['REGISTER_IP_PER_MINUTE'], _bucket_storage)
+
+# 被擋下的次數統計 (每個 worker 各自累計)
+auth_metrics = Counter()
+_auth_metrics_lock = threading.Lock()
+
+
+def record_auth_metric(name):
+    with _auth_metrics_lock:
+        auth_metrics[name] += 1
+
+
+def _off_hub(fn, *args):
+    # gevent worker 裡所有連線共用同一個 OS thread，算一次 scrypt 的幾十毫秒會讓整個 worker 停住。
+    # 丟到 hub 的 threadpool 去算 (hashlib 計算時會放開 GIL)，其他協程可以繼續跑。
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('socket'):
+        from gevent import get_hub
+        return get_hub().threadpool.apply(fn, args)
+    return fn(*args)
+
+
+def hash_password(password):
+    return _off_hub(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+
+def verify_password(pwhash, password):
+    return _off_hub(check_password_hash, pwhash, password)
+
+
+@lru_cache(maxsize=None)
+def _password_hash_prefix(method):
+    # werkzeug 會把簡寫補成完整參數 (pbkdf2 -> pbkdf2:sha256:1000000)，
+    # 直接拿設定值比對的話，用簡寫的人每次登入都會重新雜湊。用它實際產生的前綴來比。
+    return generate_password_hash('', method).split('$', 1)[0]
+
+
+def password_needs_rehash(pwhash):
+    # werkzeug 的格式是 "method$salt$hash"，method 不同代表強度設定改過了
+    return pwhash.split('$', 1)[0] != _password_hash_prefix(app.config['PASSWORD_HASH_METHOD'])
+
+
+_password_hash_prefix(app.config['PASSWORD_HASH_METHOD'])  # 啟動時先算好，不要讓第一個登入的人等
+
+# ==========================================
+# 3.55 批次匯入菜單 (CSV)
+# ==========================================
+# 欄位：name, price 必填；description 新增餐點時必填，image 可留空。
+# 更新已存在的餐點時，只覆寫檔案裡有值的欄位 (例如只有 name,price 就只改價格)。
+# 一邊讀一邊驗證，不合格的列記下行號與原因；合格的列最後用一次多列 INSERT
+# (加上一次依主鍵的批次 UPDATE) 寫入，整份檔案只 commit 一次。
+MENU_IMPORT_COLUMNS = ('name', 'price', 'description', 'image')
+MENU_IMPORT_MAX_ROWS = 10000
+
+
+def _validate_menu_row(row):
+    name = (row.get('name') or '').strip()
+    description = (row.get('description') or '').strip() or None
+    image = (row.get('image') or '').strip() or None
+    if not name:
+        raise ValueError('缺少餐點名稱')
+    if len(name) > 100:
+        raise ValueError('餐點名稱超過 100 字')
+    try:
+        price = int((row.get('price') or '').strip())
+    except ValueError:
+        raise ValueError(f'價格不是整數：{row.get("price")!r}')
+    if price < 1:
+        raise ValueError('價格必須大於 0')
+    if image and (len(image) > 500 or not image.startswith('http')):
+        raise ValueError('圖片網址必須是 http 開頭且不超過 500 字')
+    return {'food_name': name, 'food_price': price,
+            'food_description': description, 'food_image': image}
+
+
+def import_menu_csv(merchant_id, text_stream, upsert=True):
+    """匯入一份菜單 CSV，回傳 {'inserted': n, 'updated': n, 'errors': [(行號, 原因)]}。"""
+    errors = []
+    reader = csv.DictReader(text_stream)
+    header = [h.strip().lower() for h in (reader.fieldnames or [])]
+    missing = [c for c in MENU_IMPORT_COLUMNS[:2] if c not in header]
+    if missing:
+        return {'inserted': 0, 'updated': 0, 'errors': [(1, f'缺少欄位：{", ".join(missing)}')]}
+    reader.fieldnames = header
+
+    # 這個商家現有的餐點名稱 -> food_id，一次查完
+    existing = dict(db.session.query(Food.food_name, Food.food_id)
+                    .filter_by(merchant_id=merchant_id).filter(Food.food_deleted_at == None).all())
+    to_insert = []
+    to_update = []
+    seen = set()
+    for row in reader:
+        line = reader.line_num
+        if len(seen) >= MENU_IMPORT_MAX_ROWS:
+            errors.append((line, f'超過單次匯入上限 {MENU_IMPORT_MAX_ROWS} 筆，之後的資料未處理'))
+            break
+        try:
+            data = _validate_menu_row(row)
+        except ValueError as e:
+            errors.append((line, str(e)))
+            continue
+        if data['food_name'] in seen:
+            errors.append((line, f'檔案中重複的餐點名稱：{data["food_name"]}'))
+            continue
+        seen.add(data['food_name'])
+
+        food_id = existing.get(data['food_name'])
+        if food_id is None:
+            if data['food_description'] is None:
+                errors.append((line, '缺少餐點描述'))
+                continue
+            data['merchant_id'] = merchant_id
+            to_insert.append(data)
+        elif upsert:
+            # 空白的欄位不覆寫，保留原本的描述與圖片
+            data = {k: v for k, v in data.items() if v is not None}
+            data['food_id'] = food_id
+            to_update.append(data)
+        else:
+            errors.append((line, f'餐點已存在：{data["food_name"]}'))
+
+    if to_insert:
+        db.session.execute(db.insert(Food), to_insert)
+    # 依主鍵的批次 UPDATE 要求每列的欄位相同，按「有哪些欄位」分組送出
+    by_columns = {}
+    for data in to_update:
+        by_columns.setdefault(tuple(sorted(data)), []).append(data)
+    for rows in by_columns.values():
+        db.session.execute(db.update(Food), rows)
+    if to_insert or to_update:
+        bump_menu_version(merchant_id)
+    db.session.commit()
+    return {'inserted': len(to_insert), 'updated': len(to_update), 'errors': errors}
+
+# ==========================================
+# 3.57 訂單寫入 (Group Commit)
+# ==========================================
+# 尖峰時段每張訂單各自 commit，資料庫的 commit 延遲就成了吞吐量上限。
+# group 模式下，request 只負責把驗證好的訂單丟進佇列，背景的 writer 每隔
+# ORDER_GROUP_COMMIT_MS 毫秒把佇列裡的訂單合併成一個 transaction 寫入，
+# commit 成功後才把訂單編號交還給各個 request。佇列滿了就直接拒絕 (backpressure)。
+
+class OrderIntakeBusy(Exception):
+    pass
+
+
+class OrderIntakeTimeout(Exception):
+    pass
+
+
+def insert_orders(rows):
+    """把訂單加進目前的 session (不 commit)，回傳 Order 物件。rows 是 Order 欄位的 dict。"""
+    orders = [Order(**row) for row in rows]
+    db.session.add_all(orders)
+    db.session.add_all([OrderEvent(order=o, merchant_id=o.merchant_id, customer_id=o.customer_id,
+                                   event_type='created') for o in orders])
+    return orders
+
+
+def set_order_status(order, status):
+    """更新訂單狀態並記一筆事件 (不 commit)。狀態沒變就什麼都不做。"""
+    if order.order_status == status:
+        return
+    order.order_status = status
+    db.session.add(OrderEvent(order_id=order.order_id, merchant_id=order.merchant_id,
+                              customer_id=order.customer_id, event_type=status))
+
+
+def read_order_events(after=0, limit=500, merchant_id=None):
+    """讀取游標 after 之後的事件 (依 event_id 由舊到新)。回傳 (事件列表, 下一次的游標)。
+
+    event_id 是 INSERT 時就配好的，commit 的順序不一定相同，所以只讀 created_at 超過
+    ORDER_EVENT_SETTLE_SECONDS 的事件。這個做法有兩個前提，不成立時事件可能被游標跳過：
+      1. created_at 是各個 app 主機自己的時鐘 (不是資料庫的)，主機之間的時間差要遠小於這個秒數；
+      2. 寫入事件的 transaction 從 INSERT 到 commit 不能超過這個秒數。
+    需要保證一筆都不漏的下游，請把秒數設得比最長的 transaction 再加上時鐘誤差還大，
+    或定期從較早的游標重讀一次 (依 event_id 去重)。
+    """
+    settled = datetime.utcnow() - timedelta(seconds=app.config['ORDER_EVENT_SETTLE_SECONDS'])
+    stmt = (db.select(OrderEvent.event_id, OrderEvent.order_id, OrderEvent.merchant_id,
+                      OrderEvent.customer_id, OrderEvent.event_type, OrderEvent.created_at)
+            .where(OrderEvent.event_id > after, OrderEvent.created_at <= settled)
+            .order_by(OrderEvent.event_id).limit(limit))
+    if merchant_id is not None:
+        stmt = stmt.where(OrderEvent.merchant_id == merchant_id)
+    events = db.session.execute(stmt).all()
+    return events, (events[-1].event_id if events else after)
+
+
+_latency_cache = {}  # (merchant_id, days) -> (到期時間, 結果)
+_latency_cache_lock = threading.Lock()
+
+
+def merchant_order_latencies(merchant_id, days=30):
+    """近 days 天內，平均「下單 -> 接單」與「接單 -> 完成」各花幾秒 (沒有資料時為 None)。
+
+    要掃過整段期間的事件，結果在每個 worker 裡快取 ORDER_LATENCY_CACHE_SECONDS 秒。
+    """
+    now = time.time()
+    cached = _latency_cache.get((merchant_id, days))
+    if cached and now < cached[0]:
+        return cached[1]
+    result = _compute_order_latencies(merchant_id, days)
+    with _latency_cache_lock:
+        for key in [k for k, (expires, _) in _latency_cache.items() if expires <= now]:
+            del _latency_cache[key]
+        _latency_cache[(merchant_id, days)] = (now + app.config['ORDER_LATENCY_CACHE_SECONDS'], result)
+    return result
+
+
+def _compute_order_latencies(merchant_id, days):
+    since = datetime.utcnow() - timedelta(days=days)
+    times = {}
+    for order_id, event_type, created_at in db.session.execute(
+            db.select(OrderEvent.order_id, OrderEvent.event_type, OrderEvent.created_at)
+            .where(OrderEvent.merchant_id == merchant_id, OrderEvent.created_at >= since,
+                   OrderEvent.event_type.in_(('created', 'accepted', 'completed')))):
+        times.setdefault(order_id, {})[event_type] = created_at
+
+    def average(start, end):
+        spans = [(t[end] - t[start]).total_seconds() for t in times.values() if start in t and end in t]
+        return sum(spans) / len(spans) if spans else None
+
+    return {'accept': average('created', 'accepted'), 'complete': average('accepted', 'completed')}
+
+
+class _IntakeTicket:
+    def __init__(self, rows):
+        self.rows = rows
+        self.order_ids = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class OrderIntake:
+    def __init__(self, app):
+        self.app = app
+        self.queue = queue.Queue(maxsize=app.config['ORDER_INTAKE_QUEUE_SIZE'])
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, rows):
+        self._ensure_started()
+        ticket = _IntakeTicket(rows)
+        try:
+            self.queue.put_nowait(ticket)
+        except queue.Full:
+            raise OrderIntakeBusy()
+        if not ticket.done.wait(self.app.config['ORDER_INTAKE_TIMEOUT']):
+            raise OrderIntakeTimeout()
+        if ticket.error is not None:
+            raise ticket.error
+        return ticket.order_ids
+
+    def _ensure_started(self):
+        # gunicorn fork 之後才啟動，每個 worker 各自有一個 writer
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='order-intake', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        window = self.app.config['ORDER_GROUP_COMMIT_MS'] / 1000.0
+        max_batch = self.app.config['ORDER_GROUP_MAX_BATCH']
+        with self.app.app_context():
+            while True:
+                batch = [self.queue.get()]
+                deadline = time.monotonic() + window
+                while len(batch) < max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self.queue.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    # 例如 rollback 本身失敗；這一批還沒完成的單直接回報失敗，不能讓 request 等到逾時
+                    self.app.logger.exception('訂單批次寫入失敗')
+                    for t in batch:
+                        if not t.done.is_set():
+                            t.error = e
+                            t.done.set()
+                finally:
+                    try:
+                        db.session.remove()
+                    except Exception:
+                        self.app.logger.exception('清除 writer 的 session 失敗')
+
+    def _write(self, batch):
+        try:
+            per_ticket = [insert_orders(t.rows) for t in batch]
+            db.session.flush()
+            ids = [[o.order_id for o in orders] for orders in per_ticket]
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            if len(batch) > 1:
+                # 整批失敗時逐張重寫，讓有問題的那張單不會拖累其他人
+                for t in batch:
+                    self._write([t])
+            else:
+                batch[0].error = e
+                batch[0].done.set()
+            return
+        for t, order_ids in zip(batch, ids):
+            t.order_ids = order_ids
+            t.done.set()
+
+
+order_intake = OrderIntake(app)
+_intake_fallback_warned = False
+
+
+def _intake_mode(mode):
+    global _intake_fallback_warned
+    mode = mode or app.config['ORDER_INTAKE_MODE']
+    if mode == 'group' and has_request_context() and not request.environ.get('wsgi.multithread'):
+        # sync worker 一次只處理一個 request，佇列裡永遠只有自己這一張單，合併不到別人的，
+        # 只是多繞一趟背景 thread。直接寫入，並提醒一次要換 worker。
+        if not _intake_fallback_warned:
+            _intake_fallback_warned = True
+            app.logger.warning('ORDER_INTAKE_MODE=group 需要 gevent 或 gthread worker，'
+                               '目前的 worker 一次只處理一個 request，改用 direct 寫入')
+        return 'direct'
+    return mode
+
+
+def place_orders(rows, mode=None, track_trending=True):
+    """寫入訂單並回傳訂單編號 (依 rows 的順序)，commit 完成後才回傳。"""
+    if _intake_mode(mode) == 'group':
+        ids = order_intake.submit(rows)
+    else:
+        orders = insert_orders(rows)
+        db.session.flush()
+        ids = [o.order_id for o in orders]
+        db.session.commit()
+    if track_trending:
+        # 確定寫入之後才計入熱門排行；排行壞掉不能影響下單結果
+        try:
+            record_trending(rows)
+        except Exception:
+            app.logger.exception('熱門排行計數失敗')
+    return ids
+
+# ==========================================
+# 3.58 線上效能剖析 (Profiler)
+# ==========================================
+# 平常完全關閉。以下任一條件成立時，這個 request 會用 cProfile 跑一次：
+#   1. header X-Profile-Token 或網址參數 _profile 帶著管理員頁面發的簽章 token
+#   2. 依 PROFILE_SAMPLE_RATE 隨機抽中
+# 結果存成 .prof (可用 snakeviz / flameprof 轉成火焰圖)，另外記錄 SQL 與模板渲染花的時間。
+# 注意：gevent 模式下 cProfile 會一併記到同一個 worker 裡其他協程的函式呼叫。
+# 同一個 process 同時只能有一個 profiler 在跑：gevent 的協程共用同一個 thread，Python 3.11
+# 第二個 enable() 會把第一個的紀錄搶走，3.12 起 (sys.monitoring) 直接丟 ValueError。
+# 所以用一把全 process 共用的鎖，拿不到就這次不剖析。
+_profile_serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='request-profile')
+_profiler_lock = threading.Lock()
+
+
+def is_admin():
+    user = User.query.get(session['user_id']) if 'user_id' in session else None
+    return bool(user and user.user_email.lower() in app.config['ADMIN_EMAILS'])
+
+
+def make_profile_token():
+    return _profile_serializer.dumps('profile')
+
+
+def _profile_requested():
+    token = request.headers.get('X-Profile-Token') or request.args.get('_profile')
+    if token:
+        try:
+            _profile_serializer.loads(token, max_age=app.config['PROFILE_TOKEN_MAX_AGE'])
+            return True
+        except BadSignature:
+            return False
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    return rate > 0 and random.random() < rate
+
+
+@app.before_request
+def start_profiler():
+    if request.endpoint == 'static' or not _profile_requested():
+        return
+    if not _profiler_lock.acquire(blocking=False):
+        return  # 另一個 request 正在剖析
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # 例如 debugger 或其他工具已經佔用了 profiler
+        _profiler_lock.release()
+        app.logger.warning('無法啟動效能剖析，這個 request 略過', exc_info=True)
+        return
+    g.profile_stats = {'sql_count': 0, 'sql_time': 0.0, 'template_time': 0.0, 'started': time.perf_counter()}
+    g.profiler = profiler
+
+
+def _release_profiler():
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        try:
+            profiler.disable()
+        finally:
+            _profiler_lock.release()
+    return profiler
+
+
+@app.after_request
+def stop_profiler(response):
+    profiler = _release_profiler()
+    if profiler is None:
+        return response
+    stats = g.pop('profile_stats')
+    total = time.perf_counter() - stats.pop('started')
+    try:
+        _save_profile(profiler, stats, total, response.status_code)
+    except OSError:
+        app.logger.exception('無法儲存效能剖析結果')
+    return response
+
+
+@app.teardown_request
+def discard_profiler(exc):
+    # after_request 沒跑到 (例如中途丟出例外) 時，也要停掉 profiler、把鎖還回去
+    _release_profiler()
+
+
+def _save_profile(profiler, stats, total, status_code):
+    folder = app.config['PROFILE_DIR']
+    os.makedirs(folder, exist_ok=True)
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', request.path).strip('_') or 'root'
+    name = f"{datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')}_{request.method}_{slug}"
+    profiler.dump_stats(os.path.join(folder, name + '.prof'))
+    args = [(k, v) for k, v in request.args.items(multi=True) if k != '_profile']  # token 不要寫進紀錄
+    meta = {
+        'method': request.method,
+        'path': request.path + ('?' + '&'.join(f'{k}={v}' for k, v in args) if args else ''),
+        'status': status_code,
+        'user_id': session.get('user_id'),
+        'total_ms': round(total * 1000, 1),
+        'sql_count': stats['sql_count'],
+        'sql_ms': round(stats['sql_time'] * 1000, 1),
+        'template_ms': round(stats['template_time'] * 1000, 1),
+        'created_at': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    with open(os.path.join(folder, name + '.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+    # 只保留最新的 PROFILE_MAX_FILES 份
+    names = sorted(n[:-5] for n in os.listdir(folder) if n.endswith('.json'))
+    for old in names[:-app.config['PROFILE_MAX_FILES']]:
+        for ext in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(folder, old + ext))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles():
+    folder = app.config['PROFILE_DIR']
+    if not os.path.isdir(folder):
+        return []
+    result = []
+    for n in sorted(os.listdir(folder), reverse=True):
+        if n.endswith('.json'):
+            with open(os.path.join(folder, n), encoding='utf-8') as f:
+                meta = json.load(f)
+            meta['name'] = n[:-5]
+            result.append(meta)
+    return result
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _profile_sql_start(conn, cursor, statement, parameters, context, executemany):
+    if g and 'profile_stats' in g:
+        conn.info.setdefault('profile_query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _profile_sql_end(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('profile_query_start')
+    if starts and g and 'profile_stats' in g:
+        g.profile_stats['sql_count'] += 1
+        g.profile_stats['sql_time'] += time.perf_counter() - starts.pop()
+
+
+@before_render_template.connect_via(app)
+def _profile_template_start(sender, template, context, **extra):
+    if 'profile_stats' in g:
+        g.setdefault('profile_template_start', []).append(time.perf_counter())
+
+
+@template_rendered.connect_via(app)
+def _profile_template_end(sender, template, context, **extra):
+    starts = g.get('profile_template_start')
+    if starts and 'profile_stats' in g:
+        g.profile_stats['template_time'] += time.perf_counter() - starts.pop()
+
+# ==========================================
+# 3.59 熱門排行 (Trending)
+# ==========================================
+# 下單時把「餐點份數」和「商家訂單數」加進以 5 分鐘為單位的時間桶，首頁只要讀
+# 快取好的排行，不用每次重新彙總 orders 表。記憶體版本會定期壓縮：超過一小時的
+# 5 分鐘桶併成 1 小時桶、只留前 TRENDING_KEEP_KEYS 名，超過一天的直接丟掉。
+TRENDING_BUCKET_SECONDS = 300
+TRENDING_WINDOWS = {'hour': 3600, 'day': 86400}
+TRENDING_KEEP_KEYS = 200
+
+
+class MemoryTrendStorage:
+    COMPACT_INTERVAL = 60
+
+    def __init__(self):
+        self._fine = {}    # 5 分鐘桶：{桶開始時間: Counter}
+        self._coarse = {}  # 1 小時桶
+        self._lock = threading.Lock()
+        self._last_compact = 0
+
+    def add(self, counts, now):
+        bucket = int(now // TRENDING_BUCKET_SECONDS) * TRENDING_BUCKET_SECONDS
+        with self._lock:
+            self._fine.setdefault(bucket, Counter()).update(counts)
+            if now - self._last_compact >= self.COMPACT_INTERVAL:
+                self._compact(now)
+
+    def _compact(self, now):
+        self._last_compact = now
+        hour_ago = now - TRENDING_WINDOWS['hour']
+        for bucket in [b for b in self._fine if b + TRENDING_BUCKET_SECONDS <= hour_ago]:
+            hour = int(bucket // 3600) * 3600
+            self._coarse.setdefault(hour, Counter()).update(self._fine.pop(bucket))
+        day_ago = now - TRENDING_WINDOWS['day']
+        for hour in list(self._coarse):
+            if hour + 3600 <= day_ago:
+                del self._coarse[hour]
+            elif len(self._coarse[hour]) > TRENDING_KEEP_KEYS:
+                self._coarse[hour] = Counter(dict(self._coarse[hour].most_common(TRENDING_KEEP_KEYS)))
+
+    def totals(self, window, now):
+        since = now - window
+        total = Counter()
+        with self._lock:
+            # 5 分鐘桶只要有重疊就算；1 小時桶必須整個落在區間內，
+            # 否則「近一小時」會把壓縮進去、其實已經快兩小時前的訂單也算進來
+            for start, counts in self._fine.items():
+                if start + TRENDING_BUCKET_SECONDS > since:
+                    total.update(counts)
+            for start, counts in self._coarse.items():
+                if start >= since:
+                    total.update(counts)
+        return total
+
+    def replace_with(self, other):
+        with self._lock:
+            self._fine, self._coarse = other._fine, other._coarse
+            self._last_compact = other._last_compact
+
+
+class RedisTrendStorage:
+    shared = True  # 所有 worker 共用同一份計數
+
+    def __init__(self, url, name):
+        import redis
+        self._client = redis.Redis.from_url(url)
+        self._prefix = f'foodsheep:trend:{name}:'
+
+    def add(self, counts, now):
+        bucket = int(now // TRENDING_BUCKET_SECONDS) * TRENDING_BUCKET_SECONDS
+        key = self._prefix + str(bucket)
+        pipe = self._client.pipeline()
+        for member, n in counts.items():
+            pipe.hincrby(key, member, n)
+        pipe.expire(key, TRENDING_WINDOWS['day'] + TRENDING_BUCKET_SECONDS)  # 過期就等於壓縮掉了
+        pipe.execute()
+
+    def totals(self, window, now):
+        last = int(now // TRENDING_BUCKET_SECONDS) * TRENDING_BUCKET_SECONDS
+        pipe = self._client.pipeline()
+        for bucket in range(last - window + TRENDING_BUCKET_SECONDS, last + 1, TRENDING_BUCKET_SECONDS):
+            pipe.hgetall(self._prefix + str(bucket))
+        total = Counter()
+        for data in pipe.execute():
+            total.update({int(k): int(v) for k, v in data.items()})
+        return total
+
+
+def _make_trend_storage(name):
+    url = app.config['TRENDING_STORAGE_URL']
+    if url:
+        try:
+            return RedisTrendStorage(url, name)
+        except ImportError:
+            app.logger.warning('TRENDING_STORAGE_URL 已設定但沒有安裝 redis，改用記憶體計數')
+    return MemoryTrendStorage()
+
+
+trending_dishes = _make_trend_storage('dishes')
+trending_merchants = _make_trend_storage('merchants')
+_trending_state = {'warmed': False, 'snapshot': None, 'expires': 0}
+_trending_lock = threading.Lock()
+
+
+def _count_orders(rows):
+    dishes = Counter()
+    merchants = Counter()
+    for row in rows:
+        merchants[row['merchant_id']] += 1
+        for fid, qty in (row.get('order_cart') or []):
+            dishes[fid] += qty
+    return dishes, merchants
+
+
+def record_trending(rows, now=None, dishes_storage=None, merchants_storage=None):
+    now = now or time.time()
+    dishes, merchants = _count_orders(rows)
+    if dishes:
+        (dishes_storage or trending_dishes).add(dishes, now)
+    if merchants:
+        (merchants_storage or trending_merchants).add(merchants, now)
+
+
+def _warm_trending():
+    # 記憶體版本在 worker 剛啟動時是空的，用過去一天的訂單補一次 (每個 worker 只做一次)。
+    # 先補進全新的計數器再整個換掉，不能疊在啟動後已經記錄的計數上，否則同一張單會算兩次。
+    # 查詢與替換之間剛好 commit 的訂單可能會漏算，排行只是參考，可以接受。
+    if getattr(trending_dishes, 'shared', False):
+        return
+    dishes, merchants = MemoryTrendStorage(), MemoryTrendStorage()
+    since = datetime.utcnow() - timedelta(seconds=TRENDING_WINDOWS['day'])
+    offset = time.time() - datetime.utcnow().timestamp()  # order_time 存的是 UTC
+    for merchant_id, cart, order_time in db.session.execute(
+            db.select(Order.merchant_id, Order.order_cart, Order.order_time)
+            .where(Order.order_time >= since).order_by(Order.order_time)):
+        record_trending([{'merchant_id': merchant_id, 'order_cart': cart}],
+                        now=order_time.timestamp() + offset,
+                        dishes_storage=dishes, merchants_storage=merchants)
+    trending_dishes.replace_with(dishes)
+    trending_merchants.replace_with(merchants)
+
+
+def _build_trending_snapshot(now):
+    top_n = app.config['TRENDING_TOP_N']
+    ranked = {}
+    for window, seconds in TRENDING_WINDOWS.items():
+        # 多取幾名，扣掉已下架的餐點後還夠顯示
+        ranked[('dishes', window)] = trending_dishes.totals(seconds, now).most_common(top_n * 2)
+        ranked[('merchants', window)] = trending_merchants.totals(seconds, now).most_common(top_n)
+
+    food_ids = {fid for (kind, _), items in ranked.items() if kind == 'dishes' for fid, _ in items}
+    merchant_ids = {mid for (kind, _), items in ranked.items() if kind == 'merchants' for mid, _ in items}
+    foods = {row.food_id: row for row in db.session.execute(
+        db.select(Food.food_id, Food.food_name, Food.food_price, Food.merchant_id)
+        .where(Food.food_id.in_(food_ids), Food.food_deleted_at == None))} if food_ids else {}
+    merchants = {row.user_id: row for row in db.session.execute(
+        db.select(User.user_id, User.user_name).where(User.user_id.in_(merchant_ids)))} if merchant_ids else {}
+
+    snapshot = {}
+    for window in TRENDING_WINDOWS:
+        snapshot['dishes_' + window] = [
+            {'food_id': fid, 'name': foods[fid].food_name, 'price': foods[fid].food_price,
+             'merchant_id': foods[fid].merchant_id, 'count': n}
+            for fid, n in ranked[('dishes', window)] if fid in foods][:top_n]
+        snapshot['merchants_' + window] = [
+            {'merchant_id': mid, 'name': merchants[mid].user_name, 'count': n}
+            for mid, n in ranked[('merchants', window)] if mid in merchants]
+    return snapshot
+
+
+def get_trending():
+    """回傳快取好的熱門排行；過期時才重新計算 (每個 worker 每 TRENDING_CACHE_SECONDS 秒最多一次)。"""
+    now = time.time()
+    with _trending_lock:
+        if _trending_state['snapshot'] is not None and now < _trending_state['expires']:
+            return _trending_state['snapshot']
+        if not _trending_state['warmed']:
+            _trending_state['warmed'] = True
+            _warm_trending()
+        snapshot = _build_trending_snapshot(now)
+        _trending_state['snapshot'] = snapshot
+        _trending_state['expires'] = now + app.config['TRENDING_CACHE_SECONDS']
+        return snapshot
+
+# ==========================================
+# 3.6 地理位置 (Geohash)
+# ==========================================
+# 沒有填座標時，用地址裡的縣市 / 行政區查表取得大概的位置 (離線，不呼叫外部 API)。
+# 越精確的名稱放越前面，查表時會先比對到。
+GEO_LOOKUP = [
+    ('信義區', 25.0330, 121.5654), ('大安區', 25.0268, 121.5434), ('中山區', 25.0685, 121.5266),
+    ('中正區', 25.0324, 121.5199), ('松山區', 25.0497, 121.5779), ('內湖區', 25.0690, 121.5886),
+    ('士林區', 25.0928, 121.5246), ('北投區', 25.1321, 121.4987), ('萬華區', 25.0340, 121.4997),
+    ('文山區', 24.9897, 121.5701), ('板橋區', 25.0116, 121.4637), ('新莊區', 25.0359, 121.4500),
+    ('中壢區', 24.9655, 121.2246), ('西屯區', 24.1815, 120.6169), ('北屯區', 24.1826, 120.6864),
+    ('苓雅區', 22.6217, 120.3125), ('左營區', 22.6869, 120.2952),
+    ('台北市', 25.0375, 121.5637), ('臺北市', 25.0375, 121.5637), ('新北市', 25.0120, 121.4658),
+    ('基隆市', 25.1276, 121.7392), ('桃園市', 24.9936, 121.3010), ('新竹市', 24.8138, 120.9675),
+    ('新竹縣', 24.8387, 121.0178), ('苗栗縣', 24.5602, 120.8214), ('台中市', 24.1477, 120.6736),
+    ('臺中市', 24.1477, 120.6736), ('彰化縣', 24.0518, 120.5161), ('南投縣', 23.9610, 120.9719),
+    ('雲林縣', 23.7092, 120.4313), ('嘉義市', 23.4801, 120.4491), ('嘉義縣', 23.4518, 120.2555),
+    ('台南市', 22.9999, 120.2270), ('臺南市', 22.9999, 120.2270), ('高雄市', 22.6273, 120.3014),
+    ('屏東縣', 22.5519, 120.5488), ('宜蘭縣', 24.7021, 121.7378), ('花蓮縣', 23.9872, 121.6016),
+    ('台東縣', 22.7583, 121.1444), ('臺東縣', 22.7583, 121.1444),
+]
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 9
+EARTH_RADIUS_KM = 6371.0
+
+
+def lookup_coordinates(address):
+    if not address:
+        return None
+    for name, lat, lng in GEO_LOOKUP:
+        if name in address:
+            return lat, lng
+    return None
+
+
+def geohash_encode(lat, lng, precision=GEOHASH_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    ch = 0
+    even = True  # geohash 從經度開始，經緯度的 bit 交錯排列
+    while len(chars) < precision:
+        rng, value = (lng_range, lng) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        ch <<= 1
+        if value >= mid:
+            ch |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_BASE32[ch])
+            bits = 0
+            ch = 0
+    return ''.join(chars)
+
+
+def geohash_cell_size(precision):
+    # 回傳 (緯度高度, 經度寬度)，單位是度
+    lat_bits = (5 * precision) // 2
+    lng_bits = 5 * precision - lat_bits
+    return 180.0 / (2 ** lat_bits), 360.0 / (2 ** lng_bits)
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def geohash_cover(lat, lng, radius_km):
+    """回傳涵蓋以 (lat, lng) 為中心、半徑 radius_km 範圍的 geohash 前綴 (中心格 + 周圍 8 格)。"""
+    km_per_deg_lat = 111.32
+    km_per_deg_lng = 111.32 * max(math.cos(math.radians(lat)), 0.01)
+    precision = 0
+    # 找出格子邊長還大於半徑的最細精度，這樣 3x3 的格子一定包住整個圓
+    for p in range(GEOHASH_PRECISION, 0, -1):
+        h, w = geohash_cell_size(p)
+        if h * km_per_deg_lat >= radius_km and w * km_per_deg_lng >= radius_km:
+            precision = p
+            break
+    if precision == 0:
+        return None  # 半徑太大，直接掃全部商家
+    h, w = geohash_cell_size(precision)
+    cells = set()
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            clat = min(max(lat + dy * h, -90.0), 90.0)
+            clng = (lng + dx * w + 180.0) % 360.0 - 180.0
+            cells.add(geohash_encode(clat, clng, precision))
+    return sorted(cells)
+
+
+def set_user_location(user, lat=None, lng=None):
+    """有輸入座標就用輸入的，否則從地址查表；都沒有就清空。"""
+    if lat is None or lng is None:
+        found = lookup_coordinates(user.user_position)
+        lat, lng = found if found else (None, None)
+    user.user_lat = lat
+    user.user_lng = lng
+    user.user_geohash = geohash_encode(lat, lng) if lat is not None else None
+
+
+def merchants_within(lat, lng, radius_km):
+    """回傳 [(商家列, 距離公里)]，依距離由近到遠排序。"""
+    criteria = [User.user_geohash != None]
+    cells = geohash_cover(lat, lng, radius_km)
+    if cells:
+        criteria.append(or_(*[User.user_geohash.like(c + '%') for c in cells]))
+    result = []
+    for m in merchant_cards(*criteria):
+        dist = haversine_km(lat, lng, m.user_lat, m.user_lng)
+        if dist <= radius_km:
+            result.append((m, dist))
+    result.sort(key=lambda x: x[1])
+    return result
+
 # ==========================================
 # 4. 路由邏輯 (Routes)
 # ==========================================
@@ -159,23 +1425,60 @@ def index():
     
     # 1. 接收前端傳來的排序參數 (預設為 None)
     sort_order = request.args.get('sort') 
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = app.config['MERCHANTS_PER_PAGE']
+    radius_km = request.args.get('radius', app.config['NEARBY_RADIUS_KM'], type=float)
+
+    # ★ 顧客有座標時，預設改成依距離排序，只列出半徑內的商家
+    #   (還沒有任何商家有座標時維持原本的順序，否則首頁會變成空的)
+    customer = User.query.get(session['user_id']) if 'user_id' in session else None
+    has_location = bool(customer and customer.user_lat is not None)
+    if sort_order is None and has_location and db.session.query(
+            User.query.filter(User.user_identity == 'merchant', User.user_geohash != None).exists()).scalar():
+        sort_order = 'distance'
+    if sort_order == 'distance' and not has_location:
+        sort_order = None
+
+    distances = {}
+    if sort_order == 'distance':
+        nearby = merchants_within(customer.user_lat, customer.user_lng, radius_km)
+        total = len(nearby)
+        page_items = nearby[(page - 1) * per_page: page * per_page]
+        merchants = [m for m, _ in page_items]
+        distances = {m.user_id: d for m, d in page_items}
+    elif sort_order in ('desc', 'asc'):
+        # 評分排序要看全部商家，但只需要一次 GROUP BY，不用把評論一筆筆撈出來
+        ratings = dict(db.session.query(Review.merchant_id, func.avg(Review.rating))
+                       .group_by(Review.merchant_id).all())
+        merchant_ids = [uid for (uid,) in db.session.query(User.user_id)
+                        .filter_by(user_identity='merchant').order_by(User.user_id).all()]
+        merchant_ids.sort(key=lambda uid: round(float(ratings.get(uid) or 0), 1),
+                          reverse=(sort_order == 'desc'))
+        total = len(merchant_ids)
+        page_ids = merchant_ids[(page - 1) * per_page: page * per_page]
+        merchant_by_id = {m.user_id: m for m in merchant_cards(User.user_id.in_(page_ids))}
+        merchants = [merchant_by_id[uid] for uid in page_ids]
+    else:
+        # 如果沒傳參數，就維持原本的 ID 順序
+        total = User.query.filter_by(user_identity='merchant').count()
+        merchants = merchant_cards(order_by=User.user_id, offset=(page - 1) * per_page, limit=per_page)
+
+    # 只替這一頁的商家撈封面圖與評分
+    page_ids = [m.user_id for m in merchants]
+    covers = {}
+    for mid, img in (db.session.query(Food.merchant_id, Food.food_image)
+                     .filter(Food.merchant_id.in_(page_ids), Food.food_image != None, Food.food_deleted_at == None)
+                     .order_by(Food.food_id).all()):
+        covers.setdefault(mid, img)
+    stats = {mid: (cnt, avg) for mid, cnt, avg in
+             db.session.query(Review.merchant_id, func.count(Review.review_id), func.avg(Review.rating))
+             .filter(Review.merchant_id.in_(page_ids)).group_by(Review.merchant_id).all()}
 
-    merchants = User.query.filter_by(user_identity='merchant').all()
-    
     merchant_list = []
     for m in merchants:
-        # (這裡保持原本的圖片處理邏輯)
-        cover_food = Food.query.filter_by(merchant_id=m.user_id).filter(Food.food_image != None).first()
-        img_url = cover_food.food_image if (cover_food and cover_food.food_image) else 'https://www.shutterstock.com/shutterstock/videos/1093608713/thumb/7.jpg?ip=x480'
-        
-        # (這裡保持原本的評分計算邏輯)
-        reviews = Review.query.filter_by(merchant_id=m.user_id).all()
-        review_count = len(reviews)
-        
-        avg_rating = 0.0 # 預設浮點數
-        if review_count > 0:
-            total_stars = sum([r.rating for r in reviews])
-            avg_rating = round(total_stars / review_count, 1)
+        img_url = covers.get(m.user_id) or 'https://www.shutterstock.com/shutterstock/videos/1093608713/thumb/7.jpg?ip=x480'
+        review_count, avg = stats.get(m.user_id, (0, None))
+        avg_rating = round(float(avg), 1) if review_count > 0 else 0.0
             
         merchant_list.append({
             'id': m.user_id,
@@ -183,19 +1486,22 @@ def index():
             'address': m.user_position,
             'image': img_url,
             'rating': avg_rating,
-            'review_count': review_count
+            'review_count': review_count,
+            'distance': round(distances[m.user_id], 1) if m.user_id in distances else None
         })
-    
-    # ★ 新增：根據 sort_order 進行排序
-    if sort_order == 'desc':
-        # 降冪 (高 -> 低)：reverse=True
-        merchant_list.sort(key=lambda x: x['rating'], reverse=True)
-    elif sort_order == 'asc':
-        # 升冪 (低 -> 高)：reverse=False
-        merchant_list.sort(key=lambda x: x['rating'], reverse=False)
-    # 如果沒傳參數，就維持原本的 ID 順序
+
+    # 熱門排行掛了 (例如 Redis 斷線) 就不顯示，首頁照常
+    try:
+        trending = get_trending()
+    except Exception:
+        app.logger.exception('讀取熱門排行失敗')
+        db.session.rollback()
+        trending = {}
         
-    return render_template('index.html', merchants=merchant_list, current_sort=sort_order)
+    return render_template('index.html', merchants=merchant_list, current_sort=sort_order,
+                           trending=trending,
+                           has_location=has_location, radius_km=radius_km,
+                           page=page, has_prev=page > 1, has_next=page * per_page < total)
 
 
 # app.py
@@ -207,11 +1513,31 @@ def login():
     if form.validate_on_submit():
         email = form.email.data
         password = form.password.data
+
+        # ★ 先做便宜的檢查，再做昂貴的密碼雜湊
+        if len(password) > app.config['PASSWORD_MAX_LENGTH']:
+            record_auth_metric('login_rejected_length')
+            flash('登入失敗，請檢查 Email 或密碼。', 'danger')
+            return render_template('login.html', form=form), 400
+        if not login_ip_bucket.allow(request.remote_addr):
+            record_auth_metric('login_rejected_ip')
+            flash('嘗試登入次數過多，請稍後再試。', 'danger')
+            return render_template('login.html', form=form), 429
+        if not login_account_bucket.allow(email.strip().lower()):
+            record_auth_metric('login_rejected_account')
+            flash('此帳號嘗試登入次數過多，請稍後再試。', 'danger')
+            return render_template('login.html', form=form), 429
         
         # 這裡假設資料庫欄位是 user_email 和 user_password
         user = User.query.filter_by(user_email=email).first()
         
-        if user and check_password_hash(user.user_password, password):
+        if user and verify_password(user.user_password, password):
+            # 雜湊強度設定改過的話，趁現在有明文密碼時順便重新雜湊
+            if password_needs_rehash(user.user_password):
+                user.user_password = hash_password(password)
+                db.session.commit()
+                record_auth_metric('password_rehashed')
+
             # 登入成功，將資料寫入 Session
             session['user_id'] = user.user_id
             session['user_name'] = user.user_name
@@ -229,6 +1555,7 @@ def login():
             else:
                 return redirect(url_for('index'))
         else:
+            record_auth_metric('login_failed')
             flash('登入失敗，請檢查 Email 或密碼。', 'danger')
             
     return render_template('login.html', form=form)
@@ -247,27 +1574,124 @@ def merchant_orders():
         return redirect(url_for('index'))
 
     # 只撈取訂單相關資料
-    my_orders = Order.query.filter_by(merchant_id=session['user_id']).order_by(Order.order_time.desc()).all()
-    
-    # 準備訂單顯示需要的關聯資料
-    food_ids = set()
-    customer_ids = set()
-    for o in my_orders:
-        customer_ids.add(o.customer_id)
-        if o.order_cart:
-            for item in o.order_cart:
-                food_ids.add(item[0])
-                
-    foods = Food.query.filter(Food.food_id.in_(food_ids)).all()
-    food_map = {f.food_id: f for f in foods}
+    my_orders = (Order.query.filter_by(merchant_id=session['user_id'])
+                 .options(selectinload(Order.customer))
+                 .order_by(Order.order_time.desc()).all())
     
-    customers = User.query.filter(User.user_id.in_(customer_ids)).all()
-    customer_map = {u.user_id: u for u in customers}
+    # 準備訂單顯示需要的關聯資料 (顧客透過 relationship 一次撈齊)
+    food_map = get_loader(Food).load_many(cart_food_ids(my_orders))
+    latencies = merchant_order_latencies(session['user_id'])
 
     return render_template('merchant_orders.html', 
                            orders=my_orders, 
-                           food_map=food_map, 
-                           customer_map=customer_map)
+                           food_map=food_map,
+                           latencies=latencies)
+
+# ★ 新增：訂單事件流 (JSON)，用 ?after=<游標> 往後讀，回應裡的 next 就是下一次的游標
+@app.route('/merchant/order_events')
+@login_required
+def merchant_order_events():
+    if session.get('user_identity') != 'merchant':
+        abort(403)
+    after = request.args.get('after', 0, type=int)
+    limit = min(request.args.get('limit', 500, type=int), 1000)
+    events, cursor = read_order_events(after, limit, merchant_id=session['user_id'])
+    return jsonify(next=cursor, events=[{
+        'event_id': e.event_id,
+        'order_id': e.order_id,
+        'customer_id': e.customer_id,
+        'event_type': e.event_type,
+        'created_at': e.created_at.isoformat() + 'Z',
+    } for e in events])
+
+# ★ 新增：匯出訂單紀錄 (CSV，給商家對帳用)
+# 用 server-side cursor 分批讀取、邊讀邊寫，一整年的訂單也不會一次塞進記憶體
+# 訂單只記了餐點編號與數量，沒有存下單當時的價格，所以單價與小計是用「目前」的菜單價格算的；
+# 實際收款以「訂單總額」為準。
+ORDER_EXPORT_COLUMNS = ['訂單編號', '下單時間', '狀態', '顧客', '餐點編號', '餐點名稱',
+                        '目前單價', '數量', '小計 (以目前單價計)', '訂單總額']
+ORDER_EXPORT_BATCH = 500
+
+
+def _parse_export_date(value):
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d')
+
+
+def _export_order_rows(merchant_id, start, end):
+    # 菜單的大小有限，先一次撈好餐點名稱與目前的單價
+    foods = {fid: (name, price) for fid, name, price in
+             db.session.query(Food.food_id, Food.food_name, Food.food_price).filter_by(merchant_id=merchant_id)}
+    query = (db.session.query(Order.order_id, Order.order_time, Order.order_status,
+                              Order.order_cart, Order.total_price, User.user_name)
+             .join(User, User.user_id == Order.customer_id)
+             .filter(Order.merchant_id == merchant_id))
+    if start:
+        query = query.filter(Order.order_time >= start)
+    if end:
+        query = query.filter(Order.order_time < end + timedelta(days=1))
+    query = query.order_by(Order.order_time, Order.order_id).execution_options(yield_per=ORDER_EXPORT_BATCH)
+
+    for order_id, order_time, status, cart, total, customer_name in query:
+        time_str = order_time.strftime('%Y-%m-%d %H:%M:%S') if order_time else ''
+        for fid, qty in (cart or []):
+            name, price = foods.get(fid, ('(已刪除的餐點)', None))
+            line_total = price * qty if price is not None else ''
+            yield [order_id, time_str, status, customer_name, fid, name,
+                   '' if price is None else price, qty, line_total, total]
+        if not cart:
+            yield [order_id, time_str, status, customer_name, '', '', '', '', '', total]
+
+
+def _csv_chunks(rows, compress=False):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31 -> gzip 格式
+
+    def flush():
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    buffer.write('\ufeff')  # BOM，Excel 開啟中文才不會變亂碼
+    writer.writerow(ORDER_EXPORT_COLUMNS)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % ORDER_EXPORT_BATCH == 0:
+            chunk = flush()
+            if chunk:
+                yield chunk
+    chunk = flush()
+    if compressor:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
+
+
+@app.route('/merchant/orders/export')
+@login_required
+def export_merchant_orders():
+    if session.get('user_identity') != 'merchant':
+        return redirect(url_for('index'))
+
+    try:
+        start = _parse_export_date(request.args.get('start'))
+        end = _parse_export_date(request.args.get('end'))
+    except ValueError:
+        flash('日期格式錯誤，請使用 YYYY-MM-DD', 'danger')
+        return redirect(url_for('merchant_orders'))
+
+    compress = request.args.get('gzip') == '1'
+    filename = f"orders_{start.strftime('%Y%m%d') if start else 'all'}_{end.strftime('%Y%m%d') if end else 'now'}.csv"
+    rows = _export_order_rows(session['user_id'], start, end)
+    if compress:
+        filename += '.gz'
+    response = Response(stream_with_context(_csv_chunks(rows, compress)),
+                        mimetype='application/gzip' if compress else 'text/csv; charset=utf-8')
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
 
 # ★ 新增：專門管理菜單的頁面
 @app.route('/merchant/menu')
@@ -277,7 +1701,7 @@ def merchant_menu():
         return redirect(url_for('index'))
 
     # 只撈取菜單資料
-    my_foods = Food.query.filter_by(merchant_id=session['user_id']).all()
+    my_foods = menu_cards(session['user_id'])
     
     return render_template('merchant_menu.html', foods=my_foods)
 
@@ -296,15 +1720,15 @@ def merchant_order_action(order_id, action):
         flash('權限不足', 'danger')
         return redirect(url_for('merchant_dashboard'))
         
-    # 狀態機邏輯
+    # 狀態機邏輯 (每次轉換都會記一筆訂單事件)
     if action == 'accept':
-        order.order_status = 'accepted' # 接單 (製作中)
+        set_order_status(order, 'accepted') # 接單 (製作中)
         flash(f'訂單 #{order_id} 已接單！', 'success')
     elif action == 'complete':
-        order.order_status = 'completed' # 完成
+        set_order_status(order, 'completed') # 完成
         flash(f'訂單 #{order_id} 已完成並送達！', 'success')
     elif action == 'reject':
-        order.order_status = 'rejected' # 拒絕
+        set_order_status(order, 'rejected') # 拒絕
         flash(f'訂單 #{order_id} 已拒絕。', 'warning')
         
     db.session.commit()
@@ -323,7 +1747,7 @@ def customer_cancel_order(order_id):
         
     # 只有 "pending" (未接單) 的狀態才能取消
     if order.order_status == 'pending':
-        order.order_status = 'cancelled'
+        set_order_status(order, 'cancelled')
         db.session.commit()
         flash(f'訂單 #{order_id} 已成功取消。', 'success')
     else:
@@ -348,6 +1772,7 @@ def add_food():
             food_image=form.food_image.data 
         )
         db.session.add(new_food)
+        bump_menu_version(session['user_id'])
         db.session.commit()
         flash('商品上架成功！', 'success')
         return redirect(url_for('merchant_menu'))
@@ -358,8 +1783,8 @@ def add_food():
 @app.route('/merchant/edit_food/<int:food_id>', methods=['GET', 'POST'])
 @login_required
 def edit_food(food_id):
-    # 1. 撈取商品資料
-    food = Food.query.get_or_404(food_id)
+    # 1. 撈取商品資料 (已下架的商品不能再編輯)
+    food = Food.active().filter_by(food_id=food_id).first_or_404()
     
     # 2. 安全檢查：確認這商品是該商家的
     if food.merchant_id != session['user_id']:
@@ -375,6 +1800,7 @@ def edit_food(food_id):
         food.food_price = form.price.data
         food.food_description = form.description.data
         food.food_image = form.food_image.data
+        bump_menu_version(food.merchant_id)
         
         db.session.commit()
         flash(f'商品「{food.food_name}」更新成功！', 'success')
@@ -393,23 +1819,45 @@ def edit_food(food_id):
 @app.route('/merchant/delete_food/<int:food_id>')
 @login_required
 def delete_food(food_id):
-    food = Food.query.get_or_404(food_id)
+    food = Food.active().filter_by(food_id=food_id).first_or_404()
     
     # 安全檢查
     if food.merchant_id != session['user_id']:
         flash('權限不足', 'danger')
         return redirect(url_for('merchant_menu'))
-        
-    try:
-        db.session.delete(food)
-        db.session.commit()
-        flash('商品已刪除', 'success')
-    except Exception as e:
-        db.session.rollback()
-        flash(f'刪除失敗 (可能該商品已有訂單紀錄)：{e}', 'danger')
+
+    # 軟刪除：只標記下架時間，歷史訂單仍然看得到這道餐點
+    food.food_deleted_at = datetime.utcnow()
+    bump_menu_version(food.merchant_id)
+    db.session.commit()
+    flash('商品已刪除', 'success')
         
     return redirect(url_for('merchant_menu'))
 
+# ★ 新增：用 CSV 批次匯入菜單
+@app.route('/merchant/import_menu', methods=['GET', 'POST'])
+@login_required
+def import_menu():
+    if session.get('user_identity') != 'merchant':
+        return redirect(url_for('index'))
+
+    form = ImportMenuForm()
+    result = None
+    if form.validate_on_submit():
+        # 直接包住上傳的檔案串流逐行讀取，不先整份讀進記憶體
+        stream = io.TextIOWrapper(form.csv_file.data.stream, encoding='utf-8-sig', newline='')
+        try:
+            result = import_menu_csv(session['user_id'], stream, upsert=form.upsert.data)
+        except (UnicodeDecodeError, csv.Error) as e:
+            db.session.rollback()
+            flash(f'無法讀取 CSV 檔 (請確認是 UTF-8 編碼)：{e}', 'danger')
+            return render_template('import_menu.html', form=form, result=None)
+        category = 'warning' if result['errors'] else 'success'
+        flash(f"匯入完成：新增 {result['inserted']} 筆、更新 {result['updated']} 筆、"
+              f"失敗 {len(result['errors'])} 筆", category)
+
+    return render_template('import_menu.html', form=form, result=result)
+
 # ★ 新增：登出功能
 @app.route('/logout')
 def logout():
@@ -421,12 +1869,21 @@ def logout():
 def register():
     form = RegistrationForm()
     if form.validate_on_submit():
+        if len(form.password.data) > app.config['PASSWORD_MAX_LENGTH']:
+            record_auth_metric('register_rejected_length')
+            flash('密碼過長！', 'danger')
+            return render_template('register.html', form=form), 400
+        if not register_ip_bucket.allow(request.remote_addr):
+            record_auth_metric('register_rejected_ip')
+            flash('註冊次數過多，請稍後再試。', 'danger')
+            return render_template('register.html', form=form), 429
+
         # 檢查 Email 是否重複
         if User.query.filter_by(user_email=form.email.data).first():
             flash('此 Email 已被註冊！', 'danger')
             return redirect(url_for('register'))
 
-        hashed_pw = generate_password_hash(form.password.data)
+        hashed_pw = hash_password(form.password.data)
         new_user = User(
             user_name=form.name.data,
             user_email=form.email.data,
@@ -435,6 +1892,7 @@ def register():
             user_contact=form.contact.data,
             user_identity=form.identity.data
         )
+        set_user_location(new_user, form.latitude.data, form.longitude.data)
         db.session.add(new_user)
         db.session.commit()
         flash('註冊成功！請登入。', 'success')
@@ -446,7 +1904,7 @@ def register():
 @app.route('/buy/<int:food_id>', methods=['GET', 'POST'])
 @login_required 
 def buy_food(food_id):
-    target_food = Food.query.get_or_404(food_id)
+    target_food = Food.active().filter_by(food_id=food_id).first_or_404()
     form = SimpleOrderForm()
     form.food_id.data = food_id 
     
@@ -455,14 +1913,19 @@ def buy_food(food_id):
         total = target_food.food_price * qty
         cart_data = [[target_food.food_id, qty]]
         
-        new_order = Order(
-            merchant_id=target_food.merchant_id,
-            customer_id=session['user_id'], # 使用 Session 中的 ID
-            total_price=total,
-            order_cart=cart_data
-        )
-        db.session.add(new_order)
-        db.session.commit()
+        try:
+            place_orders([dict(
+                merchant_id=target_food.merchant_id,
+                customer_id=session['user_id'], # 使用 Session 中的 ID
+                total_price=total,
+                order_cart=cart_data
+            )])
+        except OrderIntakeBusy:
+            flash('目前訂單量過大，請稍後再試。', 'warning')
+            return redirect(url_for('buy_food', food_id=food_id))
+        except OrderIntakeTimeout:
+            flash('訂單可能還在處理中，請先在「我的訂單」確認；沒有看到訂單再重新下單。', 'warning')
+            return redirect(url_for('my_orders'))
         flash('訂單已送出！商家正在確認中。', 'success')
         return redirect(url_for('my_orders'))
         
@@ -480,8 +1943,8 @@ def add_to_cart():
     food_id = request.form.get('food_id')
     quantity = request.form.get('quantity')
     
-    # 除錯用：印出來看看有沒有收到資料 (會在下方的終端機顯示)
-    print(f"嘗試加入購物車: ID={food_id}, Qty={quantity}")
+    # 除錯用：記錄有沒有收到資料 (開 debug 時會在終端機顯示)
+    app.logger.debug('嘗試加入購物車: ID=%s, Qty=%s', food_id, quantity)
 
     if food_id and quantity:
         food_id = int(food_id)
@@ -538,7 +2001,7 @@ def view_cart():
         qty = item.get('qty', 0)
         
         food = Food.query.get(food_id)
-        if not food:
+        if not food or food.food_deleted_at is not None:
             continue
             
         merchant = User.query.get(food.merchant_id)
@@ -628,8 +2091,7 @@ def checkout():
     cart = session['cart']
     # 1. 撈出購物車內所有商品的資料
     food_ids = [item['food_id'] for item in cart]
-    foods = Food.query.filter(Food.food_id.in_(food_ids)).all()
-    food_map = {f.food_id: f for f in foods}
+    food_map = get_loader(Food).load_many(food_ids)
     
     orders_to_create = {}
     
@@ -638,7 +2100,7 @@ def checkout():
         fid = item['food_id']
         qty = item['qty']
         food = food_map.get(fid)
-        if not food: continue
+        if not food or food.food_deleted_at is not None: continue
         
         mid = food.merchant_id
         if mid not in orders_to_create:
@@ -648,12 +2110,15 @@ def checkout():
         orders_to_create[mid]['subtotal'] += cost
         orders_to_create[mid]['cart_data'].append([fid, qty])
 
-    # 紀錄新建立的訂單，稍後傳給前端顯示
-    new_orders = []
+    # 紀錄要建立的訂單，寫入後再撈回來傳給前端顯示
+    order_rows = []
     
     # ★ 新增：取得 VIP 狀態
     is_vip = session.get('is_vip', False)
 
+    # 所有商家一次撈齊，迴圈裡和結帳頁面都直接從這裡拿
+    merchant_map = get_loader(User).load_many(orders_to_create.keys())
+
     try:
         for mid, data in orders_to_create.items():
             subtotal = data['subtotal']
@@ -662,7 +2127,7 @@ def checkout():
             
             # 1. 取得該商家的運費設定 (如果沒設定，預設為 60)
             # 為了保險，我們先抓出商家物件
-            merchant = User.query.get(mid)
+            merchant = merchant_map.get(mid)
             original_fee = getattr(merchant, 'delivery_fee', 60) 
             
             # 2. 判斷運費
@@ -681,34 +2146,37 @@ def checkout():
             
             # ---------------------------------------------
             
-            new_order = Order(
+            order_rows.append(dict(
                 merchant_id=mid,
                 customer_id=session['user_id'],
                 total_price=final_price, # 這裡存入的就會是扣掉優惠後的價格
                 order_cart=data['cart_data'],
                 order_status='pending'
-            )
-            db.session.add(new_order)
-            new_orders.append(new_order) 
+            ))
             
-        db.session.commit() # 存入資料庫
-        
+        order_ids = place_orders(order_rows) # 存入資料庫 (commit 完成才會回傳)
         session.pop('cart', None) # 清空購物車
-        
-        # 撈一下商家資料給前端顯示用
-        merchant_ids = list(orders_to_create.keys())
-        merchants = User.query.filter(User.user_id.in_(merchant_ids)).all()
-        merchant_map = {m.user_id: m for m in merchants}
+
+        new_orders = Order.query.filter(Order.order_id.in_(order_ids)).order_by(Order.order_id).all()
+        refresh_all(list(merchant_map.values()) + list(food_map.values()))  # 結帳頁會用到商家名稱與餐點
         
         return render_template('order_confirmation.html', 
                              orders=new_orders, 
                              food_map=food_map, 
                              merchant_map=merchant_map,
                              is_vip=is_vip) # 多傳一個 is_vip 給前端，方便顯示文字
-        
+
+    except OrderIntakeBusy:
+        flash('目前訂單量過大，請稍後再試，購物車內容已保留。', 'warning')
+        return redirect(url_for('view_cart'))
+    except OrderIntakeTimeout:
+        # 不確定有沒有寫入 (可能還在佇列裡，也可能失敗了)，購物車先保留，
+        # 請顧客到「我的訂單」確認，沒看到訂單再重新結帳
+        flash('訂單可能還在處理中，請先到「我的訂單」確認；沒有看到訂單再重新結帳，購物車內容已保留。', 'warning')
+        return redirect(url_for('my_orders'))
     except Exception as e:
         db.session.rollback()
-        print(e) # 印出錯誤以便除錯
+        app.logger.exception('結帳失敗') # 記錄錯誤以便除錯
         flash(f'結帳失敗：{e}', 'danger')
         return redirect(url_for('view_cart'))
     
@@ -781,30 +2249,18 @@ def add_review(order_id):
 @app.route('/my_orders')
 @login_required
 def my_orders():
-    orders = Order.query.filter_by(customer_id=session['user_id']).order_by(Order.order_time.desc()).all()
+    orders = customer_order_rows(session['user_id'])
     
     # ★ 改用 Review 查詢
     my_reviews = Review.query.filter_by(customer_id=session['user_id']).all()
     reviewed_order_ids = [r.order_id for r in my_reviews] 
 
-    # (原本的 food_map, merchant_map 邏輯保持不變，省略...)
-    # ... 記得這裡要把上面的 food_map 等程式碼補齊 ...
-    
-    # 這裡只列出需要改動的部分，其他不變
-    all_food_ids = set()
-    for order in orders:
-        if order.order_cart:
-            for item in order.order_cart:
-                all_food_ids.add(item[0])
-    foods = Food.query.filter(Food.food_id.in_(all_food_ids)).all()
-    food_map = {f.food_id: f for f in foods}
-    merchants = User.query.filter_by(user_identity='merchant').all()
-    merchant_map = {m.user_id: m for m in merchants}
+    # 商家名稱已經 JOIN 進來，餐點只撈顯示需要的欄位
+    food_map = food_cards(cart_food_ids(orders))
 
     return render_template('my_orders.html', 
                            orders=orders, 
                            food_map=food_map, 
-                           merchant_map=merchant_map,
                            reviewed_order_ids=reviewed_order_ids)
 
 # ==========================================
@@ -812,28 +2268,39 @@ def my_orders():
 # ==========================================
 @app.route('/shop/<int:merchant_id>')
 def merchant_shop(merchant_id):
-    merchant = User.query.get_or_404(merchant_id)
-    foods = Food.query.filter_by(merchant_id=merchant_id).all()
-    
-    # ★ 改用 Review 查詢
-    reviews = Review.query.filter_by(merchant_id=merchant_id).order_by(Review.created_at.desc()).all()
+    # 商家、菜單、評論三個查詢互不相依，用 pipeline 一次送出
+    merchants, foods, reviews = execute_pipelined(
+        shop_merchant_stmt(merchant_id),
+        menu_cards_stmt(merchant_id, description_chars=30),
+        review_rows_stmt(merchant_id))
+    if not merchants:
+        abort(404)
+    merchant = merchants[0]
     
     avg_rating = 0
     if reviews:
         # ★ 這裡改成 r.rating
         total = sum([r.rating for r in reviews])
         avg_rating = round(total / len(reviews), 1)
-        
-    customer_ids = [r.customer_id for r in reviews]
-    customers = User.query.filter(User.user_id.in_(customer_ids)).all()
-    user_map = {u.user_id: u for u in customers}
 
-    return render_template('shop.html', 
+    response = app.make_response(render_template('shop.html', 
                            merchant=merchant, 
                            foods=foods,
                            reviews=reviews,       
-                           avg_rating=avg_rating, 
-                           user_map=user_map)
+                           avg_rating=avg_rating))
+    response.headers['X-Menu-Version'] = str(merchant.menu_version)
+    return response
+
+# 給前端 / 快取層用：只回傳菜單版本，版本沒變就不用重新抓整份菜單
+@app.route('/shop/<int:merchant_id>/menu_version')
+def merchant_menu_version(merchant_id):
+    version = db.session.query(User.menu_version).filter_by(
+        user_id=merchant_id, user_identity='merchant').scalar()
+    if version is None:
+        abort(404)
+    response = jsonify(merchant_id=merchant_id, menu_version=version)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/settings', methods=['GET', 'POST'])
 @login_required
@@ -845,11 +2312,16 @@ def settings():
         # 更新資料
         user.user_name = form.name.data
         user.user_contact = form.contact.data
+        lat, lng = form.latitude.data, form.longitude.data
+        if form.address.data != user.user_position and (lat, lng) == (user.user_lat, user.user_lng):
+            # 地址改了但座標沒動 (還是舊的)，改用新地址重新推算
+            lat = lng = None
         user.user_position = form.address.data
+        set_user_location(user, lat, lng)
         
         # 如果有輸入新密碼才更新
         if form.new_password.data:
-            user.user_password = generate_password_hash(form.new_password.data)
+            user.user_password = hash_password(form.new_password.data)
             
         db.session.commit()
         
@@ -864,6 +2336,10 @@ def settings():
         form.name.data = user.user_name
         form.contact.data = user.user_contact
         form.address.data = user.user_position
+        # 只帶入使用者自己填的座標；從地址推算出來的留白，改地址時才會跟著重新推算
+        if user.user_lat is not None and (user.user_lat, user.user_lng) != lookup_coordinates(user.user_position):
+            form.latitude.data = user.user_lat
+            form.longitude.data = user.user_lng
 
     # 如果是商家，計算一下目前的平均評分 (對應你的截圖需求 user_rating)
     current_rating = "無評分"
@@ -886,7 +2362,9 @@ def merchant_reviews():
         return redirect(url_for('index'))
 
     # 2. 撈取該商家的所有評論 (依時間倒序)
-    reviews = Review.query.filter_by(merchant_id=session['user_id']).order_by(Review.created_at.desc()).all()
+    reviews = (Review.query.filter_by(merchant_id=session['user_id'])
+               .options(selectinload(Review.customer))
+               .order_by(Review.created_at.desc()).all())
 
     # 3. 計算平均分數 (為了符合你要的 header 樣式)
     avg_rating = 0
@@ -894,15 +2372,10 @@ def merchant_reviews():
         total_score = sum([r.rating for r in reviews])
         avg_rating = round(total_score / len(reviews), 1)
 
-    # 4. 撈取評論者的名字 (因為 Review 表只有 customer_id)
-    customer_ids = [r.customer_id for r in reviews]
-    customers = User.query.filter(User.user_id.in_(customer_ids)).all()
-    customer_map = {u.user_id: u for u in customers}
-
+    # 評論者的名字已經透過 Review.customer 一次撈齊
     return render_template('merchant_reviews.html', 
                            reviews=reviews, 
-                           avg_rating=avg_rating,
-                           customer_map=customer_map)
+                           avg_rating=avg_rating)
 
 
 # --- 會員升級頁面 ---
@@ -945,6 +2418,45 @@ def process_upgrade():
     return redirect(url_for('index'))
 
 
+# --- 管理員：效能剖析紀錄 ---
+PROFILE_NAME_RE = re.compile(r'^[A-Za-z0-9_\-]+$')
+
+
+@app.route('/admin/profiles')
+@login_required
+def admin_profiles():
+    if not is_admin():
+        abort(404)
+    detail = None
+    name = request.args.get('name')
+    if name and PROFILE_NAME_RE.match(name):
+        path = os.path.join(app.config['PROFILE_DIR'], name + '.prof')
+        if os.path.exists(path):
+            out = io.StringIO()
+            pstats.Stats(path, stream=out).sort_stats('cumulative').print_stats(40)
+            detail = {'name': name, 'text': out.getvalue()}
+    return render_template('admin_profiles.html', profiles=list_profiles(), detail=detail,
+                           token=make_profile_token(), sample_rate=app.config['PROFILE_SAMPLE_RATE'])
+
+
+@app.route('/admin/profiles/<name>.prof')
+@login_required
+def download_profile(name):
+    if not is_admin() or not PROFILE_NAME_RE.match(name):
+        abort(404)
+    return send_from_directory(app.config['PROFILE_DIR'], name + '.prof', as_attachment=True)
+
+
+# --- 登入防護統計 ---
+@app.route('/metrics/auth')
+def auth_metrics_view():
+    token = app.config['METRICS_TOKEN']
+    if not token or request.headers.get('X-Metrics-Token') != token:
+        abort(404)
+    with _auth_metrics_lock:
+        return jsonify(dict(auth_metrics))
+
+
 @app.context_processor
 def inject_user():
     user = None
@@ -966,6 +2478,182 @@ def login_required(f):
     return decorated_function
 
 
+# --- 指令：flask import-menu <商家 ID> <CSV 檔> ---
+@app.cli.command('import-menu')
+@click.argument('merchant_id', type=int)
+@click.argument('csv_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--no-upsert', is_flag=True, help='同名餐點視為錯誤，不更新')
+def import_menu_command(merchant_id, csv_path, no_upsert):
+    merchant = User.query.get(merchant_id)
+    if not merchant or merchant.user_identity != 'merchant':
+        raise click.ClickException(f'找不到商家 #{merchant_id}')
+    with open(csv_path, encoding='utf-8-sig', newline='') as f:
+        result = import_menu_csv(merchant_id, f, upsert=not no_upsert)
+    for line, reason in result['errors']:
+        click.echo(f'第 {line} 行：{reason}', err=True)
+    click.echo(f"新增 {result['inserted']} 筆、更新 {result['updated']} 筆、失敗 {len(result['errors'])} 筆")
+
+
+# --- 指令：flask backfill-locations，替升級前就存在、還沒有 geohash 的使用者補上座標 ---
+@app.cli.command('backfill-locations')
+@click.option('--batch-size', default=500, show_default=True)
+def backfill_locations(batch_size):
+    ids = [uid for (uid,) in db.session.execute(
+        db.select(User.user_id).where(User.user_geohash == None).order_by(User.user_id))]
+    located = 0
+    for i in range(0, len(ids), batch_size):
+        for user in User.query.filter(User.user_id.in_(ids[i:i + batch_size])):
+            set_user_location(user, user.user_lat, user.user_lng)
+            located += user.user_geohash is not None
+        db.session.commit()
+    click.echo(f'檢查 {len(ids)} 位使用者，{located} 位補上座標，其餘地址查不到，請到設定頁手動填寫')
+
+
+# --- 指令：flask bench-order-intake，比較 direct 與 group 兩種寫入模式的每秒訂單數 ---
+@app.cli.command('bench-order-intake')
+@click.option('--customer-id', type=int, required=True)
+@click.option('--merchant-id', type=int, required=True)
+@click.option('--orders', 'total', default=2000, show_default=True)
+@click.option('--concurrency', default=50, show_default=True)
+def bench_order_intake(customer_id, merchant_id, total, concurrency):
+    row = dict(merchant_id=merchant_id, customer_id=customer_id, total_price=0,
+               order_cart=[], order_status='bench')
+
+    def worker(mode, count, out):
+        with app.app_context():
+            for _ in range(count):
+                out.extend(place_orders([dict(row)], mode=mode, track_trending=False))
+            db.session.remove()
+
+    for mode in ('direct', 'group'):
+        created = []
+        per_thread = total // concurrency
+        threads = [threading.Thread(target=worker, args=(mode, per_thread, created)) for _ in range(concurrency)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        click.echo(f'{mode:>6}: {len(created)} 筆訂單，{elapsed:.2f} 秒，{len(created) / elapsed:.0f} 筆/秒')
+        # 清掉測試資料
+        OrderEvent.query.filter(OrderEvent.order_id.in_(created)).delete(synchronize_session=False)
+        Order.query.filter(Order.order_id.in_(created)).delete(synchronize_session=False)
+        db.session.commit()
+
+
+# --- 指令：flask bench-read-path，比較完整 ORM 物件與只取欄位的列表查詢 ---
+@app.cli.command('bench-read-path')
+@click.option('--merchant-id', type=int, required=True, help='拿來測菜單的商家 (菜單越大越有感)')
+@click.option('--customer-id', type=int, required=True, help='拿來測訂單列表的顧客')
+@click.option('--repeat', default=20, show_default=True)
+def bench_read_path(merchant_id, customer_id, repeat):
+    cases = [
+        ('菜單 ORM', lambda: Food.active().filter_by(merchant_id=merchant_id).all()),
+        ('菜單 欄位', lambda: menu_cards(merchant_id, description_chars=30)),
+        ('訂單 ORM', lambda: Order.query.filter_by(customer_id=customer_id)
+                              .options(selectinload(Order.merchant))
+                              .order_by(Order.order_time.desc()).all()),
+        ('訂單 欄位', lambda: customer_order_rows(customer_id)),
+    ]
+    for label, fn in cases:
+        db.session.remove()
+        fn()  # 先暖身，讓連線與編譯過的 SQL 快取都準備好
+        db.session.remove()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            rows = fn()
+            db.session.remove()
+        elapsed = (time.perf_counter() - start) / repeat
+        tracemalloc.start()
+        rows = fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        db.session.remove()
+        click.echo(f'{label}: {len(rows)} 筆，平均 {elapsed * 1000:.1f} ms，記憶體高峰 {peak / 1024:.0f} KiB')
+
+
+# --- 指令：flask bench-hot-queries，檢查熱門查詢有沒有命中 SQLAlchemy 的編譯快取，
+#     並在 psycopg 3 上比較 prepared statement 與 pipeline 省下的時間 ---
+@app.cli.command('bench-hot-queries')
+@click.option('--merchant-id', type=int, required=True)
+@click.option('--customer-id', type=int, required=True)
+@click.option('--repeat', default=200, show_default=True)
+def bench_hot_queries(merchant_id, customer_id, repeat):
+    from sqlalchemy.engine.default import CACHE_HIT
+
+    food_ids = [fid for (fid,) in db.session.query(Food.food_id).filter_by(merchant_id=merchant_id).limit(5)]
+    queries = [
+        ('index 商家列表', lambda: merchant_cards_stmt(order_by=User.user_id, limit=app.config['MERCHANTS_PER_PAGE'])),
+        ('shop 商家', lambda: shop_merchant_stmt(merchant_id)),
+        ('shop 菜單', lambda: menu_cards_stmt(merchant_id, description_chars=30)),
+        ('shop 評論', lambda: review_rows_stmt(merchant_id)),
+        ('my_orders 訂單', lambda: customer_order_rows_stmt(customer_id)),
+        ('checkout 餐點', lambda: food_cards_stmt(food_ids or [0])),
+    ]
+    shop = lambda: (shop_merchant_stmt(merchant_id), menu_cards_stmt(merchant_id, description_chars=30),
+                    review_rows_stmt(merchant_id))
+
+    hits = []
+    listener = lambda conn, cursor, statement, params, context, executemany: hits.append(
+        context is not None and context.cache_hit == CACHE_HIT)
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        for label, build in queries:
+            db.session.execute(build()).all()  # 第一次編譯
+            hits.clear()
+            start = time.perf_counter()
+            for _ in range(repeat):
+                db.session.execute(build()).all()  # 每次都重建 statement，跟 request 裡一樣
+            elapsed = (time.perf_counter() - start) / repeat
+            click.echo(f'{label}: 編譯快取命中 {sum(hits)}/{len(hits)}，平均 {elapsed * 1000:.2f} ms')
+
+        # shop 頁面實際走的路徑：execute_pipelined (psycopg 3 用 pipeline，其他驅動依序執行)
+        execute_pipelined(*shop())
+        hits.clear()
+        before = Counter(pipeline_sql_stats)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            execute_pipelined(*shop())
+        elapsed = (time.perf_counter() - start) / repeat
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+
+    raw = db.session.connection().connection.driver_connection
+    if hasattr(raw, 'pipeline'):
+        used = pipeline_sql_stats - before
+        click.echo(f'shop 頁面 (execute_pipelined，pipeline)：SQL 快取命中 {used["hit"]}/{used["hit"] + used["miss"]}，'
+                   f'平均 {elapsed * 1000:.2f} ms')
+    else:
+        click.echo(f'shop 頁面 (execute_pipelined，依序執行)：編譯快取命中 {sum(hits)}/{len(hits)}，'
+                   f'平均 {elapsed * 1000:.2f} ms')
+        click.echo('目前不是 psycopg 3 (DB_DRIVER=psycopg)，略過 prepared statement / pipeline 比較')
+        return
+
+    for label, build in queries:
+        sql, params = _pipeline_sql(build(), db.session.connection().dialect)
+        timing = {}
+        for prepare in (False, True):
+            cur = raw.cursor()
+            cur.execute(sql, params, prepare=prepare)  # 暖身 (prepare=True 時在這裡 PREPARE)
+            cur.fetchall()
+            start = time.perf_counter()
+            for _ in range(repeat):
+                cur.execute(sql, params, prepare=prepare)
+                cur.fetchall()
+            timing[prepare] = (time.perf_counter() - start) / repeat
+            cur.close()
+        saved = (1 - timing[True] / timing[False]) * 100 if timing[False] else 0
+        click.echo(f'{label}: 一般 {timing[False] * 1000:.2f} ms，prepared {timing[True] * 1000:.2f} ms (省 {saved:.0f}%)')
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for stmt in shop():
+            db.session.execute(stmt).all()
+    sequential = (time.perf_counter() - start) / repeat
+    click.echo(f'shop 三個查詢：依序 {sequential * 1000:.2f} ms，pipeline {elapsed * 1000:.2f} ms')
+
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
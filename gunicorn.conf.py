@@ -0,0 +1,22 @@
+# gunicorn 啟動時會自動讀取這個檔案 (gunicorn app:app)
+# 預設維持原本的 sync worker；設定 GUNICORN_WORKER_CLASS=gevent 就改成協程模式，
+# 一個 worker 等 Postgres 回應的時候可以同時服務其他連線。
+import os
+import sys
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+# gevent 模式下，每個 worker 最多同時處理的連線數
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+
+
+def post_fork(server, worker):
+    # 看實際啟動的 worker，不看上面的預設值：命令列 -k gevent 會蓋掉 worker_class 設定
+    ggevent = sys.modules.get('gunicorn.workers.ggevent')
+    if ggevent is not None and isinstance(worker, ggevent.GeventWorker):
+        # psycopg2 是 C 寫的，gevent 的 monkey patch 管不到，
+        # 要掛上 wait callback 才會在等資料庫時把控制權讓出去
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+        server.log.info('worker %s: psycopg2 已切換成 gevent 相容模式', worker.pid)
@@ -0,0 +1,65 @@
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# 必須在 import app 之前設定好。預設用暫存的 sqlite 檔案；要在 Postgres 上跑就設定
+# TEST_DATABASE_URL (請指向專用的測試資料庫，每個測試都會清空重建所有資料表)
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL') or \
+    'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='foodsheep-test-'), 'test.db')
+os.environ['RATELIMIT_STORAGE_URL'] = ''
+os.environ['TRENDING_STORAGE_URL'] = ''
+os.environ['ORDER_INTAKE_MODE'] = 'direct'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as foodsheep  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    foodsheep.app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    foodsheep._latency_cache.clear()  # 每個測試的資料庫都是新的，各 worker 的快取也要清掉
+    with foodsheep.app.app_context():
+        foodsheep.db.drop_all()
+        foodsheep.db.create_all()
+    yield foodsheep.app
+    with foodsheep.app.app_context():
+        foodsheep.db.session.remove()
+        foodsheep.db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def login(client, user):
+    with client.session_transaction() as sess:
+        sess['user_id'] = user['user_id']
+        sess['user_name'] = user['user_name']
+        sess['user_identity'] = user['user_identity']
+        sess['is_vip'] = False
+
+
+@pytest.fixture
+def count_queries():
+    """用法：with count_queries() as statements: ...，結束後 statements 就是執行過的所有 SQL。"""
+    @contextmanager
+    def counter():
+        statements = []
+
+        def on_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(Engine, 'before_cursor_execute', on_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(Engine, 'before_cursor_execute', on_execute)
+
+    return counter
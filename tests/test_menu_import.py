@@ -0,0 +1,46 @@
+import io
+
+from conftest import foodsheep
+
+
+def setup_menu():
+    db, User, Food = foodsheep.db, foodsheep.User, foodsheep.Food
+    merchant = User(user_name='merchant', user_email='merchant@example.com', user_password='x',
+                    user_identity='merchant')
+    db.session.add(merchant)
+    db.session.flush()
+    db.session.add_all([
+        Food(food_name='牛肉麵', food_price=150, food_description='紅燒', food_image='https://img/1.jpg',
+             merchant_id=merchant.user_id),
+        Food(food_name='滷肉飯', food_price=40, food_description='小碗', food_image='https://img/2.jpg',
+             merchant_id=merchant.user_id),
+    ])
+    db.session.commit()
+    return merchant.user_id
+
+
+def test_upsert_keeps_columns_left_blank(app):
+    with app.app_context():
+        merchant_id = setup_menu()
+        csv_text = ('name,price,description,image\n'
+                    '牛肉麵,180,,\n'
+                    '滷肉飯,45,大碗,\n')
+        result = foodsheep.import_menu_csv(merchant_id, io.StringIO(csv_text))
+        assert result == {'inserted': 0, 'updated': 2, 'errors': []}
+
+        foods = {f.food_name: f for f in foodsheep.Food.query.all()}
+        assert (foods['牛肉麵'].food_price, foods['牛肉麵'].food_description, foods['牛肉麵'].food_image) == \
+            (180, '紅燒', 'https://img/1.jpg')
+        assert (foods['滷肉飯'].food_price, foods['滷肉飯'].food_description, foods['滷肉飯'].food_image) == \
+            (45, '大碗', 'https://img/2.jpg')
+
+
+def test_price_only_file_updates_prices_but_new_dishes_need_description(app):
+    with app.app_context():
+        merchant_id = setup_menu()
+        csv_text = 'name,price\n牛肉麵,160\n蚵仔煎,70\n'
+        result = foodsheep.import_menu_csv(merchant_id, io.StringIO(csv_text))
+        assert result == {'inserted': 0, 'updated': 1, 'errors': [(3, '缺少餐點描述')]}
+
+        beef = foodsheep.Food.query.filter_by(food_name='牛肉麵').one()
+        assert (beef.food_price, beef.food_description, beef.food_image) == (160, '紅燒', 'https://img/1.jpg')
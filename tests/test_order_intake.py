@@ -0,0 +1,129 @@
+"""group 模式的背景 writer：合併成一個 transaction、整批失敗時逐張重寫、等太久時回報逾時。"""
+import threading
+import time
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from conftest import foodsheep, login
+
+
+@pytest.fixture
+def people(app):
+    with app.app_context():
+        merchant = foodsheep.User(user_name='merchant', user_email='merchant@example.com', user_password='x',
+                                  user_identity='merchant')
+        customer = foodsheep.User(user_name='customer', user_email='customer@example.com', user_password='x',
+                                  user_identity='customer')
+        foodsheep.db.session.add_all([merchant, customer])
+        foodsheep.db.session.flush()
+        food = foodsheep.Food(food_name='牛肉麵', food_price=150, food_description='紅燒',
+                              merchant_id=merchant.user_id)
+        foodsheep.db.session.add(food)
+        foodsheep.db.session.commit()
+        return {'merchant_id': merchant.user_id, 'customer_id': customer.user_id, 'food_id': food.food_id,
+                'customer': {'user_id': customer.user_id, 'user_name': 'customer', 'user_identity': 'customer'}}
+
+
+def order_row(people, total_price=150):
+    return dict(merchant_id=people['merchant_id'], customer_id=people['customer_id'],
+                total_price=total_price, order_cart=[[people['food_id'], 1]])
+
+
+def submit_all(intake, rows_list):
+    """每筆 rows 各開一個 thread 同時送出 (像同一個 worker 裡的多個 request)，回傳結果或例外。"""
+    results = [None] * len(rows_list)
+
+    def run(i):
+        try:
+            results[i] = intake.submit(rows_list[i])
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(rows_list))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def order_count():
+    with foodsheep.app.app_context():
+        return foodsheep.Order.query.count()
+
+
+@pytest.fixture
+def commits(app):
+    with app.app_context():
+        engine = foodsheep.db.engine
+    seen = []
+
+    def on_commit(conn):
+        seen.append(conn)
+
+    event.listen(engine, 'commit', on_commit)
+    yield seen
+    event.remove(engine, 'commit', on_commit)
+
+
+def test_concurrent_orders_share_one_commit(app, people, commits, monkeypatch):
+    monkeypatch.setitem(app.config, 'ORDER_GROUP_COMMIT_MS', 300)
+    results = submit_all(foodsheep.OrderIntake(app), [[order_row(people)] for _ in range(5)])
+
+    assert all(isinstance(r, list) and len(r) == 1 for r in results), results
+    assert len({r[0] for r in results}) == 5
+    assert len(commits) == 1
+    assert order_count() == 5
+
+
+def test_bad_order_is_retried_alone_and_does_not_fail_the_batch(app, people, commits, monkeypatch):
+    monkeypatch.setitem(app.config, 'ORDER_GROUP_COMMIT_MS', 300)
+    rows_list = [[order_row(people)], [order_row(people, total_price=None)], [order_row(people)]]
+    results = submit_all(foodsheep.OrderIntake(app), rows_list)
+
+    assert isinstance(results[1], IntegrityError)
+    assert isinstance(results[0], list) and isinstance(results[2], list)
+    assert len(commits) == 2  # 合併的那次失敗，之後兩張好的單各自 commit
+    assert order_count() == 2
+
+
+def test_slow_writer_reports_timeout_and_still_writes_the_order(app, people, monkeypatch):
+    # writer 要等滿 1 秒的合併時間才寫入，request 只願意等 0.1 秒
+    monkeypatch.setitem(app.config, 'ORDER_GROUP_COMMIT_MS', 1000)
+    monkeypatch.setitem(app.config, 'ORDER_INTAKE_TIMEOUT', 0.1)
+    with pytest.raises(foodsheep.OrderIntakeTimeout):
+        foodsheep.OrderIntake(app).submit([order_row(people)])
+
+    # 逾時只代表 request 不等了，訂單還是會寫進去 (所以頁面會請使用者先去「我的訂單」確認)
+    deadline = time.monotonic() + 5
+    while order_count() == 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert order_count() == 1
+
+
+def buy(client, people, **kwargs):
+    login(client, people['customer'])
+    return client.post(f"/buy/{people['food_id']}", data={'food_id': people['food_id'], 'quantity': 1}, **kwargs)
+
+
+def test_group_mode_falls_back_to_direct_under_sync_workers(client, people, monkeypatch):
+    intake = foodsheep.OrderIntake(foodsheep.app)
+    monkeypatch.setattr(foodsheep, 'order_intake', intake)
+    monkeypatch.setitem(foodsheep.app.config, 'ORDER_INTAKE_MODE', 'group')
+
+    assert buy(client, people).status_code == 302
+    assert intake._thread is None  # 沒有經過背景 writer
+    assert order_count() == 1
+
+
+def test_group_mode_uses_writer_under_concurrent_workers(client, people, monkeypatch):
+    intake = foodsheep.OrderIntake(foodsheep.app)
+    monkeypatch.setattr(foodsheep, 'order_intake', intake)
+    monkeypatch.setitem(foodsheep.app.config, 'ORDER_INTAKE_MODE', 'group')
+
+    # gevent / gthread worker 會把 wsgi.multithread 設成 True
+    assert buy(client, people, environ_overrides={'wsgi.multithread': True}).status_code == 302
+    assert intake._thread is not None
+    assert order_count() == 1
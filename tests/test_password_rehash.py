@@ -0,0 +1,52 @@
+from werkzeug.security import generate_password_hash
+
+from conftest import foodsheep
+
+
+def make_user(password, method):
+    with foodsheep.app.app_context():
+        user = foodsheep.User(user_name='customer', user_email='customer@example.com',
+                              user_password=generate_password_hash(password, method),
+                              user_identity='customer')
+        foodsheep.db.session.add(user)
+        foodsheep.db.session.commit()
+        return user.user_id
+
+
+def stored_hash(user_id):
+    with foodsheep.app.app_context():
+        return foodsheep.db.session.get(foodsheep.User, user_id).user_password
+
+
+def log_in(client):
+    return client.post('/login', data={'email': 'customer@example.com', 'password': 'secret123'})
+
+
+def test_short_method_name_does_not_rehash_every_login(client, monkeypatch):
+    # pbkdf2 會被 werkzeug 補成 pbkdf2:sha256:<次數>，不能因為字串不同就每次都重新雜湊
+    monkeypatch.setitem(foodsheep.app.config, 'PASSWORD_HASH_METHOD', 'pbkdf2')
+    user_id = make_user('secret123', 'pbkdf2')
+    before = stored_hash(user_id)
+    rehashed = foodsheep.auth_metrics['password_rehashed']
+
+    for _ in range(3):
+        assert log_in(client).status_code == 302
+        client.get('/logout')
+
+    assert stored_hash(user_id) == before
+    assert foodsheep.auth_metrics['password_rehashed'] == rehashed
+
+
+def test_changed_method_rehashes_once(client, monkeypatch):
+    monkeypatch.setitem(foodsheep.app.config, 'PASSWORD_HASH_METHOD', 'pbkdf2')
+    user_id = make_user('secret123', 'pbkdf2:sha256:1000')
+    rehashed = foodsheep.auth_metrics['password_rehashed']
+
+    assert log_in(client).status_code == 302
+    new_hash = stored_hash(user_id)
+    assert new_hash.startswith(generate_password_hash('', 'pbkdf2').split('$', 1)[0] + '$')
+
+    client.get('/logout')
+    assert log_in(client).status_code == 302
+    assert stored_hash(user_id) == new_hash
+    assert foodsheep.auth_metrics['password_rehashed'] == rehashed + 1
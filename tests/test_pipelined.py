@@ -0,0 +1,65 @@
+"""execute_pipelined 自己編譯 SQL、直接從 psycopg 的 cursor 拿值，結果要和 db.session.execute 一模一樣。
+
+預設的 sqlite 沒有 pipeline，只會走一般的 execute；要測到 pipeline 請用 psycopg 3 的
+TEST_DATABASE_URL (postgresql+psycopg://...)。
+"""
+from datetime import datetime
+
+from conftest import foodsheep
+
+
+def seed():
+    db, User, Food, Order, Review = (foodsheep.db, foodsheep.User, foodsheep.Food,
+                                     foodsheep.Order, foodsheep.Review)
+    merchants = [User(user_name=f'shop{i}', user_email=f'shop{i}@example.com', user_password='x',
+                      user_identity='merchant', user_position='台北市大安區', user_lat=25.0268 + i,
+                      user_lng=121.5434) for i in range(2)]
+    customer = User(user_name='customer', user_email='customer@example.com', user_password='x',
+                    user_identity='customer')
+    db.session.add_all(merchants + [customer])
+    db.session.flush()
+    for m in merchants:
+        foods = [Food(food_name=f'dish{i}', food_price=100 + i, food_description='很長的描述' * 10,
+                      food_image=None if i else 'https://img/1.jpg', merchant_id=m.user_id) for i in range(3)]
+        db.session.add_all(foods)
+        db.session.flush()
+        for i, f in enumerate(foods):
+            order = Order(merchant_id=m.user_id, customer_id=customer.user_id, total_price=f.food_price * 2,
+                          order_cart=[[f.food_id, 2]], order_status='completed',
+                          order_time=datetime(2024, 5, 1, 12, i, 30, 123456))
+            db.session.add(order)
+            db.session.flush()
+            db.session.add(Review(order_id=order.order_id, customer_id=customer.user_id, merchant_id=m.user_id,
+                                  rating=5 - i, content=None if i else '好吃',
+                                  created_at=datetime(2024, 5, 2, 8, i, 0, 654321)))
+    db.session.commit()
+    return [m.user_id for m in merchants], customer.user_id
+
+
+def statements(merchant_id, customer_id):
+    # 商家頁實際用到的三句，加上其他可能被 pipeline 的查詢 (ARRAY 欄位、IN 展開、LIMIT/OFFSET)
+    return [
+        foodsheep.shop_merchant_stmt(merchant_id),
+        foodsheep.menu_cards_stmt(merchant_id, description_chars=30),
+        foodsheep.review_rows_stmt(merchant_id),
+        foodsheep.menu_cards_stmt(merchant_id),
+        foodsheep.customer_order_rows_stmt(customer_id),
+        foodsheep.food_cards_stmt([1, 2, merchant_id + 3]),
+        foodsheep.merchant_cards_stmt(foodsheep.User.user_lat > 0, order_by=foodsheep.User.user_id,
+                                      offset=1, limit=5),
+    ]
+
+
+def as_plain(rows):
+    return [(row._fields, tuple(row)) for row in rows]
+
+
+def test_pipelined_rows_match_session_execute(app):
+    with app.app_context():
+        merchant_ids, customer_id = seed()
+        # 每個商家跑一次：第二次會用到快取的 SQL，只換參數值
+        for merchant_id in merchant_ids:
+            stmts = statements(merchant_id, customer_id)
+            expected = [as_plain(foodsheep.db.session.execute(stmt).all()) for stmt in stmts]
+            assert [as_plain(rows) for rows in foodsheep.execute_pipelined(*stmts)] == expected
+            assert all(expected), '每句都要撈到資料，否則比不出型別差異'
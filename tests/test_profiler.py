@@ -0,0 +1,27 @@
+import os
+
+from conftest import foodsheep
+
+
+def profile_files(folder):
+    return sorted(n for n in os.listdir(folder) if n.endswith('.prof')) if os.path.isdir(folder) else []
+
+
+def test_request_is_profiled_and_releases_the_profiler(client, tmp_path, monkeypatch):
+    monkeypatch.setitem(foodsheep.app.config, 'PROFILE_DIR', str(tmp_path))
+    response = client.get('/login', headers={'X-Profile-Token': foodsheep.make_profile_token()})
+    assert response.status_code == 200
+    assert len(profile_files(str(tmp_path))) == 1
+    assert not foodsheep._profiler_lock.locked()
+
+
+def test_second_profiled_request_is_skipped_while_one_is_running(client, tmp_path, monkeypatch):
+    # gevent 下同一個 thread 的另一個協程正在剖析時，這個 request 照常處理但不剖析
+    monkeypatch.setitem(foodsheep.app.config, 'PROFILE_DIR', str(tmp_path))
+    assert foodsheep._profiler_lock.acquire(blocking=False)
+    try:
+        response = client.get('/login', headers={'X-Profile-Token': foodsheep.make_profile_token()})
+    finally:
+        foodsheep._profiler_lock.release()
+    assert response.status_code == 200
+    assert profile_files(str(tmp_path)) == []
@@ -0,0 +1,98 @@
+"""每個頁面執行的 SQL 數量不能隨資料量增加 (N+1 查詢)。
+
+同一個頁面分別用少量與多量的資料跑一次，兩次的 SELECT 數都要等於 EXPECTED 裡的數字。
+只算 SELECT：結帳時每張訂單的 INSERT 在 sqlite 上會逐筆送出 (Postgres 會合併成一句)，
+那是寫入筆數，不是 N+1。頁面改版後數字變了，確認不是 N+1 再更新 EXPECTED。
+"""
+import pytest
+
+from conftest import foodsheep, login
+
+SIZES = (2, 10)
+
+EXPECTED = {
+    'my_orders': 4,
+    'merchant_orders': 5,
+    'merchant_shop': 4,
+    'merchant_reviews': 3,
+    'checkout': 6,
+}
+
+
+def seed(n):
+    """一個主要商家 (n 道菜、n 筆已完成並評論的訂單)、n 個其他商家、一個下過 n 張單的顧客。"""
+    db, User, Food, Order, Review = (foodsheep.db, foodsheep.User, foodsheep.Food,
+                                     foodsheep.Order, foodsheep.Review)
+
+    def user(name, identity):
+        u = User(user_name=name, user_email=f'{name}@example.com', user_password='x',
+                 user_identity=identity, user_position='台北市信義區')
+        db.session.add(u)
+        return u
+
+    with foodsheep.app.app_context():
+        merchant = user('merchant', 'merchant')
+        customer = user('customer', 'customer')
+        others = [user(f'shop{i}', 'merchant') for i in range(n)]
+        reviewers = [user(f'reviewer{i}', 'customer') for i in range(n)]
+        db.session.flush()
+
+        menu = [Food(food_name=f'dish{i}', food_price=100 + i, food_description='好吃',
+                     merchant_id=merchant.user_id) for i in range(n)]
+        other_foods = [Food(food_name=f'other{i}', food_price=80, food_description='好吃',
+                            merchant_id=m.user_id) for i, m in enumerate(others)]
+        db.session.add_all(menu + other_foods)
+        db.session.flush()
+
+        for m, f in zip(others, other_foods):
+            db.session.add(Order(merchant_id=m.user_id, customer_id=customer.user_id, total_price=160,
+                                 order_cart=[[f.food_id, 2]], order_status='pending'))
+        for r, f in zip(reviewers, menu):
+            order = Order(merchant_id=merchant.user_id, customer_id=r.user_id, total_price=f.food_price,
+                          order_cart=[[f.food_id, 1]], order_status='completed')
+            db.session.add(order)
+            db.session.flush()
+            db.session.add(Review(order_id=order.order_id, customer_id=r.user_id,
+                                  merchant_id=merchant.user_id, rating=4, content='不錯'))
+        db.session.commit()
+
+        def info(u):
+            return {'user_id': u.user_id, 'user_name': u.user_name, 'user_identity': u.user_identity}
+
+        return {
+            'merchant': info(merchant),
+            'customer': info(customer),
+            'cart': [{'food_id': f.food_id, 'qty': 1} for f in menu + other_foods],
+        }
+
+
+def visit(client, page, data):
+    if page == 'my_orders':
+        login(client, data['customer'])
+        return client.get('/my_orders')
+    if page == 'merchant_orders':
+        login(client, data['merchant'])
+        return client.get('/merchant/orders')
+    if page == 'merchant_shop':
+        login(client, data['customer'])
+        return client.get(f"/shop/{data['merchant']['user_id']}")
+    if page == 'merchant_reviews':
+        login(client, data['merchant'])
+        return client.get('/merchant/reviews')
+    if page == 'checkout':
+        login(client, data['customer'])
+        with client.session_transaction() as sess:
+            sess['cart'] = data['cart']
+        return client.post('/checkout')
+    raise ValueError(page)
+
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('page', sorted(EXPECTED))
+def test_query_count_does_not_grow_with_data(client, count_queries, page, size):
+    data = seed(size)
+    with count_queries() as statements:
+        response = visit(client, page, data)
+    assert response.status_code == 200
+    selects = [s for s in statements if s.lstrip().upper().startswith('SELECT')]
+    assert len(selects) == EXPECTED[page], '\n'.join(selects)
@@ -0,0 +1,31 @@
+import pytest
+
+from conftest import foodsheep
+
+pytest.importorskip('redis')
+
+# 沒有在聽的 port：連線會立刻被拒絕，跟 Redis 掛掉時一樣
+DOWN_URL = 'redis://127.0.0.1:1/0'
+
+
+def test_redis_down_falls_back_to_memory_bucket():
+    storage = foodsheep.RedisBucketStorage(DOWN_URL)
+    errors = foodsheep.auth_metrics['ratelimit_storage_error']
+
+    assert [storage.take('login-ip:1.2.3.4', 2, 0.0, 100.0) for _ in range(3)] == [True, True, False]
+    assert foodsheep.auth_metrics['ratelimit_storage_error'] == errors + 3
+
+
+def test_login_still_works_when_redis_is_down(client, monkeypatch):
+    storage = foodsheep.RedisBucketStorage(DOWN_URL)
+    for bucket in (foodsheep.login_ip_bucket, foodsheep.login_account_bucket, foodsheep.register_ip_bucket):
+        monkeypatch.setattr(bucket, 'storage', storage)
+
+    response = client.post('/login', data={'email': 'nobody@example.com', 'password': 'secret123'})
+    assert response.status_code == 200  # 帳密錯誤，回到登入頁，而不是 500
+    response = client.post('/register', data={'name': 'new', 'email': 'new@example.com', 'password': 'secret123',
+                                              'address': '台北市大安區', 'contact': '0912345678',
+                                              'identity': 'customer'})
+    assert response.status_code == 302
+    with foodsheep.app.app_context():
+        assert foodsheep.User.query.filter_by(user_email='new@example.com').count() == 1
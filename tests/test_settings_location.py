@@ -0,0 +1,68 @@
+import re
+
+from conftest import foodsheep, login
+
+TAIPEI_DAAN = (25.0268, 121.5434)
+KAOHSIUNG_LINGYA = (22.6217, 120.3125)
+
+
+def make_user(lat=None, lng=None):
+    with foodsheep.app.app_context():
+        user = foodsheep.User(user_name='customer', user_email='customer@example.com', user_password='x',
+                              user_identity='customer', user_contact='0912345678', user_position='台北市大安區')
+        foodsheep.set_user_location(user, lat, lng)
+        foodsheep.db.session.add(user)
+        foodsheep.db.session.commit()
+        return {'user_id': user.user_id, 'user_name': user.user_name, 'user_identity': user.user_identity}
+
+
+def stored_location(user_id):
+    with foodsheep.app.app_context():
+        user = foodsheep.db.session.get(foodsheep.User, user_id)
+        return user.user_lat, user.user_lng
+
+
+def field_value(html, name):
+    match = re.search(r'<input[^>]*name="%s"[^>]*>' % name, html)
+    value = re.search(r'value="([^"]*)"', match.group(0))
+    return value.group(1) if value else ''
+
+
+def save_settings(client, address, lat='', lng=''):
+    return client.post('/settings', data={'name': 'customer', 'contact': '0912345678', 'address': address,
+                                          'latitude': lat, 'longitude': lng})
+
+
+def test_looked_up_coordinates_are_not_prefilled(client):
+    user = make_user()
+    login(client, user)
+    html = client.get('/settings').get_data(as_text=True)
+    assert field_value(html, 'latitude') == ''
+    assert field_value(html, 'longitude') == ''
+
+
+def test_changing_address_moves_looked_up_location(client):
+    user = make_user()
+    login(client, user)
+    assert stored_location(user['user_id']) == TAIPEI_DAAN
+
+    save_settings(client, '高雄市苓雅區')
+    assert stored_location(user['user_id']) == KAOHSIUNG_LINGYA
+
+
+def test_changing_address_with_stale_coordinates_still_moves_location(client):
+    # 舊版頁面會把座標帶回表單，地址改了但座標沒動時也要依新地址推算
+    user = make_user(25.1, 121.6)
+    login(client, user)
+    save_settings(client, '高雄市苓雅區', '25.1', '121.6')
+    assert stored_location(user['user_id']) == KAOHSIUNG_LINGYA
+
+
+def test_typed_coordinates_are_kept(client):
+    user = make_user(25.1, 121.6)
+    login(client, user)
+    html = client.get('/settings').get_data(as_text=True)
+    assert (field_value(html, 'latitude'), field_value(html, 'longitude')) == ('25.1', '121.6')
+
+    save_settings(client, '台北市大安區', '25.1', '121.6')
+    assert stored_location(user['user_id']) == (25.1, 121.6)